@@ -1,12 +1,14 @@
 """
 һPython,Ҫͼ,ҪΪ:
-1.ʹPILͼ,SSIMFFTָͼ
-2.ʹö̲дͼ,ټ㡣
+1.ʹPILСΪ̶ߴĻҶͼ,SSIMFFTָͼ
+  봿ͼSSIMɾֲֵͷֱ,FFTָʹrfft2,ÿ̰NumPy㡣
+2.ʹö̲дͼ,ټ㡣ṩУ׼ģʽ,϶Ա¾ɵ÷ֵһԡ
 3.ָйһ
 4.÷ͼ,ҵǰNš
 5.ⱨ,гͼƬָꡣ
 6.ͼƬƵĿ¼
 7.÷֡SSIMFFTͼ
+  ʽģʽֻÿָС/ֵнĺѡѺ͹̶Сĳ,һֻԺѡ´,ͼɳķλ,ڴռòͼƬ
 8.־¼ͼƬ
 ԸóʵԴͼƬԶ뱨ɡ
 ҪõPILOpenCVscipyscikit-learnmatplotlibģ顣
@@ -16,6 +18,10 @@ import cv2
 import numpy as np
 from tqdm import tqdm
 import logging
+import heapq
+import collections
+import itertools
+import random
 from skimage.metrics import structural_similarity as ssim
 from sklearn.preprocessing import MinMaxScaler
 from shutil import copy
@@ -26,7 +32,21 @@ from PIL import Image
 
 logging.basicConfig(filename="image_processing.log", level=logging.INFO)
 
+# Every image is scored on a grayscale thumbnail of this size so a batch stacks into one array
+THUMBNAIL_SIZE = (256, 256)
+BATCH_SIZE = 64
+# Streaming mode keeps this many candidates per worst image, and this many scores for the plot
+CANDIDATE_OVERSAMPLE = 10
+# Batches submitted to the pool but not yet collected in streaming mode; keeps the task queue bounded
+MAX_PENDING_BATCHES = (os.cpu_count() or 1) * 4
+PLOT_SAMPLE_SIZE = 10000
+# skimage's default SSIM window and stabilising constants for uint8 data
+SSIM_WIN_SIZE = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
 def compute_scores(image_path):
+    # Full-resolution reference implementation, used by calibrate()
     try:
         # Use PIL to open the image and convert to grayscale
         img = Image.open(image_path).convert('L')
@@ -51,18 +71,225 @@ def compute_scores(image_path):
         logging.error(f"Failed to compute quality for {image_path} with error {e}")
         return image_path, -1, -1
 
-def check_directory(directory, n_worst):
-    scores_dict = {}
-    image_paths = []
+def load_thumbnail(image_path):
+    with Image.open(image_path) as img:
+        img.draft('L', THUMBNAIL_SIZE)  # Let libjpeg decode at a reduced scale
+        img = img.convert('L').resize(THUMBNAIL_SIZE, Image.BILINEAR, reducing_gap=2.0)
+        return np.asarray(img, dtype=np.float64)
+
+def _window_mean(stack, win_size):
+    # Mean of every win_size x win_size window lying fully inside each image, from an integral image
+    integral = np.pad(stack, ((0, 0), (1, 0), (1, 0))).cumsum(axis=1).cumsum(axis=2)
+    sums = (integral[:, win_size:, win_size:] - integral[:, :-win_size, win_size:]
+            - integral[:, win_size:, :-win_size] + integral[:, :-win_size, :-win_size])
+    return sums / (win_size * win_size)
+
+def ssim_against_white(stack):
+    # Against a constant 255 reference sigma_y and sigma_xy vanish, so SSIM only needs the local mean and variance
+    n = SSIM_WIN_SIZE * SSIM_WIN_SIZE
+    mu = _window_mean(stack, SSIM_WIN_SIZE)
+    var = (_window_mean(stack * stack, SSIM_WIN_SIZE) - mu * mu) * n / (n - 1)  # Sample variance like skimage
+    ssim_map = (2 * mu * 255 + SSIM_C1) * SSIM_C2 / ((mu * mu + 255 * 255 + SSIM_C1) * (var + SSIM_C2))
+    return ssim_map.mean(axis=(1, 2))
+
+def fft_mean_log_magnitude(stack):
+    # fftshift only reorders the spectrum, so the mean is taken over the rfft2 half with each
+    # column weighted by how many columns of the full Hermitian spectrum it stands for
+    height, width = stack.shape[1:]
+    magnitude_spectrum = 20 * np.log(np.abs(np.fft.rfft2(stack)) + 1e-8)
+    weights = np.full(magnitude_spectrum.shape[-1], 2.0)
+    weights[0] = 1.0
+    if width % 2 == 0:
+        weights[-1] = 1.0
+    return (magnitude_spectrum * weights).sum(axis=(1, 2)) / (height * width)
+
+def compute_scores_batch(image_paths):
+    thumbnails, loaded, results = [], [], []
+    for image_path in image_paths:
+        try:
+            thumbnails.append(load_thumbnail(image_path))
+            loaded.append(image_path)
+        except Exception as e:
+            logging.error(f"Failed to compute quality for {image_path} with error {e}")
+            results.append((image_path, -1, -1))
+    if thumbnails:
+        stack = np.stack(thumbnails)
+        results.extend(zip(loaded, ssim_against_white(stack).tolist(), fft_mean_log_magnitude(stack).tolist()))
+    return results
+
+def _spearman(a, b):
+    rank_a = np.argsort(np.argsort(a))
+    rank_b = np.argsort(np.argsort(b))
+    return np.corrcoef(rank_a, rank_b)[0, 1]
+
+def _quality(ssim_scores, fft_scores):
+    scores = MinMaxScaler().fit_transform(np.column_stack((ssim_scores, fft_scores)))
+    return scores.mean(axis=1)
+
+def calibrate(directory, sample_size=200, n_worst=20, seed=0):
+    """Compare the batched thumbnail scores with the full-resolution ones on a random sample."""
+    image_paths = list_images(directory)
+    rng = np.random.default_rng(seed)
+    sample = [image_paths[i] for i in rng.choice(len(image_paths), min(sample_size, len(image_paths)), replace=False)]
+
+    with Pool() as pool:
+        reference = {path: (s, f) for path, s, f in tqdm(pool.imap_unordered(compute_scores, sample), total=len(sample), desc="Full resolution")}
+        batches = [sample[i:i + BATCH_SIZE] for i in range(0, len(sample), BATCH_SIZE)]
+        fast = {path: (s, f) for batch in pool.imap_unordered(compute_scores_batch, batches) for path, s, f in batch}
+
+    ref = np.array([reference[path] for path in sample])
+    new = np.array([fast[path] for path in sample])
+    ref_quality = _quality(ref[:, 0], ref[:, 1])
+    new_quality = _quality(new[:, 0], new[:, 1])
+    overlap = len(set(np.argsort(ref_quality)[:n_worst]) & set(np.argsort(new_quality)[:n_worst]))
+
+    print(f"Calibration sample: {len(sample)} images")
+    print(f"Spearman rank correlation, SSIM: {_spearman(ref[:, 0], new[:, 0]):.4f}")
+    print(f"Spearman rank correlation, FFT: {_spearman(ref[:, 1], new[:, 1]):.4f}")
+    print(f"Spearman rank correlation, Quality: {_spearman(ref_quality, new_quality):.4f}")
+    print(f"Worst {n_worst} overlap: {overlap}/{n_worst}")
+
+def iter_images(directory):
     for foldername, subfolders, filenames in os.walk(directory):
         for filename in filenames:
             if filename.endswith('.jpg') or filename.endswith('.png'):
-                image_paths.append(os.path.join(foldername, filename))
+                yield os.path.join(foldername, filename)
+
+def list_images(directory):
+    return list(iter_images(directory))
+
+class StreamingScores:
+    """Running min/max per metric, a bounded heap of the worst candidates and a reservoir sample for the plot.
+
+    Quality depends on the final min/max, so candidates are ranked under the current ranges and the
+    heap is re-keyed whenever a range widens. Keep n_candidates comfortably above n_worst.
+    """
+
+    def __init__(self, n_candidates, sample_size=PLOT_SAMPLE_SIZE, seed=0):
+        self.n_candidates = n_candidates
+        self.sample_size = sample_size
+        self.count = 0
+        self.low = [np.inf, np.inf]
+        self.high = [-np.inf, -np.inf]
+        self.heap = []  # (-quality, image_path, ssim, fft), so the best kept candidate sits on top
+        self.sample = []
+        self.rng = random.Random(seed)
+
+    def _normalize(self, value, metric):
+        # Same as MinMaxScaler, which maps a constant feature to 0
+        span = self.high[metric] - self.low[metric]
+        return (value - self.low[metric]) / span if span > 0 else 0.0
+
+    def quality(self, ssim_score, fft_score):
+        return (self._normalize(ssim_score, 0) + self._normalize(fft_score, 1)) / 2
+
+    def add(self, image_path, ssim_score, fft_score):
+        self.count += 1
+        widened = False
+        for metric, value in enumerate((ssim_score, fft_score)):
+            if value < self.low[metric]:
+                self.low[metric] = value
+                widened = True
+            if value > self.high[metric]:
+                self.high[metric] = value
+                widened = True
+        if widened and self.heap:
+            self.heap = [(-self.quality(s, f), path, s, f) for _, path, s, f in self.heap]
+            heapq.heapify(self.heap)
+
+        item = (-self.quality(ssim_score, fft_score), image_path, ssim_score, fft_score)
+        if len(self.heap) < self.n_candidates:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+        # Reservoir sampling keeps a uniform sample of the scores for the quantile plot
+        if len(self.sample) < self.sample_size:
+            self.sample.append((ssim_score, fft_score))
+        else:
+            slot = self.rng.randrange(self.count)
+            if slot < self.sample_size:
+                self.sample[slot] = (ssim_score, fft_score)
+
+    def worst(self, n_worst):
+        """Re-score the candidates with the final ranges and return the n_worst (path, quality, ssim, fft)."""
+        rescored = sorted((self.quality(s, f), path, s, f) for _, path, s, f in self.heap)
+        return [(path, quality, s, f) for quality, path, s, f in rescored[:n_worst]]
+
+    def normalized_sample(self):
+        """Return the sampled (quality, ssim, fft) scores, normalized and sorted by quality."""
+        ssim_scores = np.array([self._normalize(s, 0) for s, _ in self.sample])
+        fft_scores = np.array([self._normalize(f, 1) for _, f in self.sample])
+        quality_scores = (ssim_scores + fft_scores) / 2
+        order = np.argsort(quality_scores)
+        return quality_scores[order], ssim_scores[order], fft_scores[order]
+
+def write_report(directory, result_dir, total, worst, n_worst):
+    # Create txt file for storing sorted images
+    with open(os.path.join(result_dir, 'LowQualityImagesReport.txt'), 'w') as f:
+        f.write(f"Image Quality Inspection Report\n")
+        f.write(f"Directory inspected: {directory}\n")
+        f.write(f"Total images inspected: {total}\n")
+        f.write(f"Number of worst quality images: {n_worst}\n\n")
+        f.write(f"List of worst quality images:\n")
+        for idx, (image_path, quality_score, ssim_score, fft_score) in enumerate(worst, start=1):
+            f.write(f"\nImage {idx}:\n")
+            f.write(f"\tPath: {image_path}\n")
+            f.write(f"\tQuality Score: {quality_score:.4f}\n")
+            f.write(f"\tSSIM Score: {ssim_score:.4f}\n")
+            f.write(f"\tFFT Score: {fft_score:.4f}\n\n")
+
+    # Copy the worst quality images to the result directory
+    for image_path, _, _, _ in worst:
+        dst = os.path.join(result_dir, os.path.basename(image_path))
+        copy(image_path, dst)
+
+def check_directory_streaming(directory, n_worst):
+    """Same report as check_directory with memory independent of the number of images."""
+    stream = StreamingScores(n_worst * CANDIDATE_OVERSAMPLE)
+    image_paths = iter_images(directory)
+    batches = iter(lambda: list(itertools.islice(image_paths, BATCH_SIZE)), [])
+    pool = Pool()
+    # imap_unordered would drain the batches generator into the task queue up front, so submit a
+    # fixed window of batches and only read more paths as results are collected
+    pending = collections.deque()
+    with tqdm(desc="Processing images") as pbar:
+        def collect_oldest():
+            results = pending.popleft().get()
+            for image_path, ssim_score, fft_score in results:
+                stream.add(image_path, ssim_score, fft_score)
+            pbar.update(len(results))
 
-    # Use multiprocessing to process images in parallel
+        for batch in batches:
+            if len(pending) >= MAX_PENDING_BATCHES:
+                collect_oldest()
+            pending.append(pool.apply_async(compute_scores_batch, (batch,)))
+        while pending:
+            collect_oldest()
+    pool.close()
+    pool.join()
+
+    # Create a directory to store the results
+    result_dir = os.path.join(os.path.dirname(directory), 'LowQualityImages')
+    os.makedirs(result_dir, exist_ok=True)
+
+    write_report(directory, result_dir, stream.count, stream.worst(n_worst), n_worst)
+
+    ## Plot the scores
+    plot_score_quantiles(stream.normalized_sample(), stream.count, result_dir)
+
+def check_directory(directory, n_worst):
+    scores_dict = {}
+    image_paths = list_images(directory)
+
+    # Use multiprocessing to process images in parallel, one batch of thumbnails per task
+    batches = [image_paths[i:i + BATCH_SIZE] for i in range(0, len(image_paths), BATCH_SIZE)]
     pool = Pool()
-    for image_path, ssim_score, fft_score in tqdm(pool.imap_unordered(compute_scores, image_paths), total=len(image_paths), desc="Processing images"):
-        scores_dict[image_path] = {'ssim': ssim_score, 'fft': fft_score}
+    with tqdm(total=len(image_paths), desc="Processing images") as pbar:
+        for results in pool.imap_unordered(compute_scores_batch, batches):
+            for image_path, ssim_score, fft_score in results:
+                scores_dict[image_path] = {'ssim': ssim_score, 'fft': fft_score}
+            pbar.update(len(results))
     pool.close()
     pool.join()
 
@@ -89,24 +316,9 @@ def check_directory(directory, n_worst):
     result_dir = os.path.join(os.path.dirname(directory), 'LowQualityImages')
     os.makedirs(result_dir, exist_ok=True)
 
-    # Create txt file for storing sorted images
-    with open(os.path.join(result_dir, 'LowQualityImagesReport.txt'), 'w') as f:
-        f.write(f"Image Quality Inspection Report\n")
-        f.write(f"Directory inspected: {directory}\n")
-        f.write(f"Total images inspected: {len(scores_dict)}\n")
-        f.write(f"Number of worst quality images: {n_worst}\n\n")
-        f.write(f"List of worst quality images:\n")
-        for idx, score in enumerate(sorted_scores[:n_worst], start=1):  # Only write the first n_worst images
-            f.write(f"\nImage {idx}:\n")
-            f.write(f"\tPath: {score[0]}\n")
-            f.write(f"\tQuality Score: {score[1]:.4f}\n")
-            f.write(f"\tSSIM Score: {scores_dict[score[0]]['ssim']:.4f}\n")
-            f.write(f"\tFFT Score: {scores_dict[score[0]]['fft']:.4f}\n\n")
-
-    # Copy the worst quality images to the result directory
-    for score in sorted_scores[:n_worst]:  # Only copy the first n_worst images
-        dst = os.path.join(result_dir, os.path.basename(score[0]))
-        copy(score[0], dst)
+    worst = [(path, quality, scores_dict[path]['ssim'], scores_dict[path]['fft'])
+             for path, quality in sorted_scores[:n_worst]]  # Only report the first n_worst images
+    write_report(directory, result_dir, len(scores_dict), worst, n_worst)
 
     ## Plot the scores
     plot_scores(sorted_scores, ssim_scores_normalized, fft_scores_normalized, quality_scores, result_dir)
@@ -136,7 +348,31 @@ def plot_scores(sorted_scores, ssim_scores_normalized, fft_scores_normalized, qu
 
     plt.savefig(os.path.join(result_dir, 'image_scores.png'))
 
+def plot_score_quantiles(normalized_sample, total, result_dir):
+    # Plot a fixed-size sample at its quantile positions, so the figure looks like plot_scores at any scale
+    quality_scores, ssim_scores, fft_scores = normalized_sample
+    fig, ax = plt.subplots()
+
+    x = (np.arange(len(quality_scores)) + 0.5) / max(len(quality_scores), 1) * total
+
+    ax.plot(x, quality_scores, label='Quality Scores', color='blue', linestyle='-')
+    ax.scatter(x, ssim_scores, s=2, label='SSIM Scores', color='green')
+    ax.scatter(x, fft_scores, s=2, label='FFT Scores', color='red')
+
+    ax.set_xlabel('Image Index')
+    ax.set_ylabel('Score')
+    ax.set_title('Image Scores')
+    ax.legend()
+
+    ax.grid(True)  # Add grid lines
+
+    ax.set_ylim(0, 1)
+
+    plt.savefig(os.path.join(result_dir, 'image_scores.png'))
+
 if __name__ == "__main__":
     source_dir = "your input folder"
     n_worst = 50
-    check_directory(source_dir, n_worst)
\ No newline at end of file
+    # calibrate(source_dir)  # Check that the thumbnail scores rank images like the full-resolution ones
+    check_directory(source_dir, n_worst)
+    # check_directory_streaming(source_dir, n_worst)  # Flat memory for very large directories
\ No newline at end of file
@@ -1,41 +1,353 @@
 """
 这是一个Python脚本,主要功能是批量处理图像文件,使用前请备份原图像。功能包括:
-1.收集所有图像的大小信息
-2.使用KMeans对图像进行聚类,得到代表性的几种尺寸
-3.按照这几种代表性尺寸,对图像进行缩放和裁剪,使其总分辨率小于1088*1088，且长宽两边像素数均是32的倍数
+1.只读取JPEG/PNG/WebP文件头收集图像的大小信息,结果缓存在磁盘索引中,再次运行时只扫描有变化的文件
+2.流式统计宽高比/面积直方图,从直方图中得到代表性的几种尺寸,每张图像O(1)分配到其输出尺寸的桶
+3.根据文件头尺寸预先计算缩放和裁剪区域,JPEG按比例缩小解码,一次重采样完成缩放和裁剪,使其总分辨率小于1088*1088，且长宽两边像素数均是32的倍数
 4.将图像以100%质量转换为JPEG格式,同时计算图像裁剪后的面积损失比例
-5.生成统计报告,包含图像尺寸分布、损失比例等信息
-6.按损失比例对图像排序,输出损失比例最大的文件
-7.删除非JPG和TXT格式的文件
-8.删除像素数过小的图像
-主要用到了os、shutil、PIL、sklearn、multiprocessing等模块,实现了图像的批量处理和统计分析等功能。
+5.边处理边在线汇总统计(Welford均值/标准差、最大/最小值、top-k堆、>10%损失的溢出文件、输出尺寸计数),内存占用与数据集大小无关,多次运行的统计结果可以合并
+6.生成统计报告,包含图像尺寸分布、损失比例等信息,并输出损失比例最大的文件
+7.删除非JPG和TXT格式的文件,像素数过小的图像不再转换,连同同名txt直接移动到small_images文件夹(保持相对路径,不覆盖已有文件),已转换过的图像再次运行时保持不变
+8.所有删除/移动操作根据扫描和转换阶段已知的信息决定,在最后一次性批量执行,不再重新遍历目录和打开图像
+主要用到了os、shutil、sqlite3、PIL、multiprocessing等模块,实现了图像的批量处理和统计分析等功能。
 """
 import os
 import collections
 import shutil
-import numpy as np
+import sqlite3
+import struct
+import itertools
+import math
+import heapq
+import json
+import time
 from PIL import Image
-from sklearn.cluster import KMeans
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 from pathlib import Path
 
-def collect_dimensions(file):
+MAX_SIDE = 1088
+MAX_PIXELS = MAX_SIDE * MAX_SIDE
+# Same reducing gap Image.thumbnail uses, non-JPEG sources are box-reduced before the LANCZOS pass
+REDUCING_GAP = 2.0
+# Aspect ratios are binned in steps of 1/8 octave when picking representative sizes
+ASPECT_BINS_PER_OCTAVE = 8
+# Images whose pixel count is more than 15% below 1088*1088 are treated as small
+SMALL_PIXELS = 0.85 * MAX_PIXELS
+# Only these files are left in the tree after processing
+KEEP_SUFFIXES = {'.jpg', '.txt'}
+
+# Only files with these extensions are treated as images; everything else is skipped before dispatch
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+# SOFn markers carry the frame dimensions (DHT, JPG and DAC share the C4/C8/CC range)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':  # Skip fill bytes
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # Standalone markers have no length field
+        if marker in (0xD9, 0xDA):
+            return None  # Reached EOI or scan data without a frame header
+        segment = f.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if marker in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>xHH', frame)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _png_size(header):
+    if header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+def _webp_size(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and header[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and header[20:21] == b'\x2f':
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+        return width, height
+    return None
+
+def read_image_size(file):
+    """Read (width, height) from the JPEG/PNG/WebP header without decoding, None for other formats."""
+    with open(file, 'rb') as f:
+        header = f.read(32)
+        if header[:3] == b'\xff\xd8\xff':
+            return _jpeg_size(f)
+        if header[:8] == b'\x89PNG\r\n\x1a\n':
+            return _png_size(header)
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return _webp_size(header)
+    return None
+
+def collect_dimensions(args):
+    file, size, mtime_ns = args
     try:
-        img = Image.open(file)
-        width, height = img.size
-        return (width, height, file)  # 返回文件路径
-    except IOError:
-        return None  # 如果文件不能被打开为图像，就跳过
-
-def write_statistics(directory, labels, common_sizes, loss_ratios):
-    # Check if all labels have corresponding sizes in common_sizes
-    if set(labels) - set(range(len(common_sizes))):
-        raise ValueError("Not all labels have corresponding sizes in common_sizes.")
-    
-    # Use collections.Counter to count the frequency of each size
-    size_counts = collections.Counter(labels)
-    total = len(labels)
+        dims = read_image_size(file)
+        if dims is None:
+            # Fall back to Pillow for the remaining formats, Image.open only parses the header
+            with Image.open(file) as img:
+                dims = img.size
+        return file, size, mtime_ns, dims
+    except (IOError, struct.error):
+        return file, size, mtime_ns, None  # 如果文件不能被打开为图像，就跳过
+
+class SizeIndex:
+    """On-disk cache of image dimensions keyed by (path, size, mtime).
+
+    Files written by compress_and_convert are marked as converted, so a later run over the same tree
+    leaves them alone instead of judging the already reduced output as a small image.
+    """
+
+    def __init__(self, index_path):
+        self.conn = sqlite3.connect(str(index_path))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sizes ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, width INTEGER, height INTEGER, '
+                          'converted INTEGER NOT NULL DEFAULT 0)')
+        # Indexes written before the converted flag existed
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(sizes)')}
+        if 'converted' not in columns:
+            self.conn.execute('ALTER TABLE sizes ADD COLUMN converted INTEGER NOT NULL DEFAULT 0')
+            self.conn.commit()
+
+    def lookup(self, entries):
+        """Split (file, size, mtime_ns) entries into cached (file, dims, converted) and entries that need a scan."""
+        placeholders = ','.join('?' * len(entries))
+        rows = self.conn.execute(f'SELECT path, size, mtime_ns, width, height, converted FROM sizes '
+                                 f'WHERE path IN ({placeholders})', [str(file) for file, _, _ in entries])
+        cached = {path: (size, mtime_ns, width, height, converted)
+                  for path, size, mtime_ns, width, height, converted in rows}
+        known, missing = [], []
+        for file, size, mtime_ns in entries:
+            row = cached.get(str(file))
+            if row is not None and row[:2] == (size, mtime_ns):
+                known.append((file, row[2:4] if row[2] is not None else None, bool(row[4])))
+            else:
+                missing.append((file, size, mtime_ns))
+        return known, missing
+
+    def update(self, results):
+        self.conn.executemany('INSERT OR REPLACE INTO sizes (path, size, mtime_ns, width, height) VALUES (?, ?, ?, ?, ?)',
+                              [(str(file), size, mtime_ns, *(dims or (None, None)))
+                               for file, size, mtime_ns, dims in results])
+        self.conn.commit()
+
+    def mark_converted(self, outputs):
+        """Record (file, (width, height)) outputs of compress_and_convert with their current size and mtime."""
+        rows = []
+        for file, dims in outputs:
+            stat = file.stat()
+            rows.append((str(file), stat.st_size, stat.st_mtime_ns, *dims))
+        self.conn.executemany('INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?, ?, 1)', rows)
+        self.conn.commit()
+
+    def forget(self, files):
+        self.conn.executemany('DELETE FROM sizes WHERE path = ?', [(str(file),) for file in files])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def _iter_image_files(directory, rejected):
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            file = Path(root) / filename
+            if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                rejected.append(file)
+                continue
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            yield file, stat.st_size, stat.st_mtime_ns
+
+def scan_dimensions(directory, index, pool, rejected, chunk_size=500):
+    """Yield (file, width, height, converted) for every image, only reading headers of files the index has not seen.
+
+    Files that are not images or cannot be read are appended to rejected.
+    """
+    stale = []
+    entries = _iter_image_files(directory, rejected)
+    while chunk := list(itertools.islice(entries, chunk_size)):
+        known, missing = index.lookup(chunk)
+        for file, dims, converted in known:
+            if dims is not None:
+                yield file, *dims, converted
+            else:
+                rejected.append(file)
+        stale.extend(missing)
+
+    updates = []
+    for result in pool.imap_unordered(collect_dimensions, stale, chunksize=64):
+        updates.append(result)
+        if len(updates) >= chunk_size:
+            index.update(updates)
+            updates.clear()
+        file, _, _, dims = result
+        if dims is not None:
+            yield file, *dims, False
+        else:
+            rejected.append(file)
+    index.update(updates)
+
+def _thumbnail_size(width, height):
+    # Same rounding as Image.thumbnail((MAX_SIDE, MAX_SIDE))
+    if width <= MAX_SIDE and height <= MAX_SIDE:
+        return width, height
+    aspect = width / height
+    x, y = MAX_SIDE, MAX_SIDE
+    if x / y >= aspect:
+        x = max(min(math.floor(y * aspect), math.ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(min(math.floor(x / aspect), math.ceil(x / aspect),
+                    key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return x, y
+
+def plan_size(width, height):
+    """Return the (scaled, output) sizes compress_and_convert produces for an image of the given size."""
+    if width * height > MAX_PIXELS:
+        width, height = _thumbnail_size(width, height)
+    return (width, height), ((width // 32) * 32, (height // 32) * 32)
+
+class SizeBuckets:
+    """Streaming aspect-ratio/area histogram of output sizes.
+
+    Each bucket is one output size (32-aligned, at most MAX_PIXELS), so the histogram stays
+    bounded however many images are added. An image's bucket is the output size plan_size computes
+    for it in O(1), which compress_and_convert returns along with the loss ratio.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def add(self, bucket):
+        self.counts[tuple(bucket)] += 1
+
+    def common_sizes(self, n_sizes):
+        """Return up to n_sizes (size, count) pairs, the most common size of each of the largest aspect-ratio bins."""
+        aspect_bins = collections.defaultdict(collections.Counter)
+        for (width, height), count in self.counts.items():
+            if width and height:
+                aspect = round(math.log2(width / height) * ASPECT_BINS_PER_OCTAVE)
+                aspect_bins[aspect][width, height] += count
+        largest = sorted(aspect_bins.values(), key=lambda sizes: sum(sizes.values()), reverse=True)[:n_sizes]
+        return [(sizes.most_common(1)[0][0], sum(sizes.values())) for sizes in largest]
+
+class LossAggregator:
+    """Online loss-ratio statistics with flat memory.
+
+    Keeps Welford mean/variance, min/max, a bounded heap of the largest losses and a counter per
+    output size. Files above large_loss are appended to a spill file instead of being kept in memory.
+    Aggregates can be saved, loaded and merged to produce one report from several runs.
+    """
+
+    def __init__(self, spill_path, top_k=10, large_loss=0.1):
+        self.top_k = top_k
+        self.large_loss = large_loss
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.top = []  # Min-heap of (ratio, file)
+        self.sizes = SizeBuckets()
+        self.spill_paths = [str(spill_path)]
+        self._spill = open(spill_path, 'w', encoding='utf-8')
+
+    def add(self, file, ratio, size):
+        self.count += 1
+        delta = ratio - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (ratio - self.mean)
+        self.min = min(self.min, ratio)
+        self.max = max(self.max, ratio)
+        if len(self.top) < self.top_k:
+            heapq.heappush(self.top, (ratio, file))
+        elif ratio > self.top[0][0]:
+            heapq.heapreplace(self.top, (ratio, file))
+        if ratio > self.large_loss:
+            if self._spill is None:
+                self._spill = open(self.spill_paths[0], 'a', encoding='utf-8')
+            self._spill.write(f"{ratio!r}\t{file}\n")
+        self.sizes.add(size)
+
+    def merge(self, other):
+        # Chan et al. pairwise combination of the Welford accumulators
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.top = heapq.nlargest(self.top_k, self.top + other.top)
+        heapq.heapify(self.top)
+        self.sizes.counts.update(other.sizes.counts)
+        self.spill_paths += other.spill_paths
+        return self
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def large_losses(self):
+        """Yield (file, ratio) for every spilled file, in arrival order."""
+        if self._spill is not None:
+            self._spill.flush()
+        for spill_path in self.spill_paths:
+            with open(spill_path, encoding='utf-8') as f:
+                for line in f:
+                    ratio, file = line.rstrip('\n').split('\t', 1)
+                    yield file, float(ratio)
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def save(self, path):
+        self.close()
+        state = {key: getattr(self, key) for key in ('top_k', 'large_loss', 'count', 'mean', 'm2', 'min', 'max',
+                                                     'top', 'spill_paths')}
+        state['sizes'] = [[width, height, count] for (width, height), count in self.sizes.counts.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        aggregator = cls.__new__(cls)
+        aggregator.__dict__.update(state, _spill=None, sizes=SizeBuckets())
+        aggregator.top = [tuple(item) for item in state['top']]
+        heapq.heapify(aggregator.top)
+        aggregator.sizes.counts.update({(width, height): count for width, height, count in state['sizes']})
+        return aggregator
+
+def write_statistics(directory, stats, n_sizes):
+    buckets = stats.sizes
+    size_counts = buckets.counts
+    total = stats.count
     
     # Calculate size_ratios
     size_ratios = {size: count / total for size, count in size_counts.items()}
@@ -43,38 +355,29 @@ def write_statistics(directory, labels, common_sizes, loss_ratios):
     # Find the most common size
     common_size = max(size_ratios, key=size_ratios.get)
 
-    # Calculate statistics of loss ratios
-    loss_ratios_values = [ratio for _, ratio in loss_ratios]
-    avg_loss_ratio = np.mean(loss_ratios_values)
-    min_loss_ratio = np.min(loss_ratios_values)
-    max_loss_ratio = np.max(loss_ratios_values)
-    std_loss_ratio = np.std(loss_ratios_values)
-
-    # Sort all files by loss ratio in descending order
-    sorted_files = sorted([(file, ratio) for file, ratio in loss_ratios], key=lambda x: x[1], reverse=True)
-    
-    # Create a list for the top 10 files with the largest loss ratio
-    top_10_loss_files = sorted_files[:10]
-    
-    # Create a list for files with a loss ratio greater than 10%
-    large_loss_files = [file_ratio for file_ratio in sorted_files if file_ratio[1] > 0.1]
-
-    # Merge and deduplicate the two lists
-    merged_files = list(dict.fromkeys(top_10_loss_files + large_loss_files))
+    # Create a list for the top files with the largest loss ratio
+    top_loss_files = [(file, ratio) for ratio, file in sorted(stats.top, reverse=True)]
 
     with open(directory / 'statistics.txt', 'w') as file:
         # Write general statistics to the file
         file.write("################ General Statistics ################\n")
         file.write(f"Total number of images: {total:,}\n")
-        file.write(f"Most common size: {common_sizes[common_size]} (Ratio: {size_ratios[common_size]*100:.2f}%)\n")
+        file.write(f"Most common size: {common_size} (Ratio: {size_ratios[common_size]*100:.2f}%)\n")
+        file.write("\n")
+
+        # Write representative sizes, one per aspect-ratio bin
+        file.write("################ Representative Sizes ################\n")
+        file.write(f"{'Size':<20}{'Count':<10}{'Ratio (%)':<10}\n")
+        for size, count in buckets.common_sizes(n_sizes):
+            file.write(f"{str(size):<20}{count:<10,}{count / total * 100:<10.2f}\n")
         file.write("\n")
 
         # Write statistics of loss ratios
         file.write("################ Loss Ratios Statistics ################\n")
-        file.write(f"Average area loss ratio: {avg_loss_ratio * 100:.2f}%\n")
-        file.write(f"Min area loss ratio: {min_loss_ratio * 100:.2f}%\n")
-        file.write(f"Max area loss ratio: {max_loss_ratio * 100:.2f}%\n")
-        file.write(f"Standard deviation of area loss ratio: {std_loss_ratio * 100:.2f}%\n")
+        file.write(f"Average area loss ratio: {stats.mean * 100:.2f}%\n")
+        file.write(f"Min area loss ratio: {stats.min * 100:.2f}%\n")
+        file.write(f"Max area loss ratio: {stats.max * 100:.2f}%\n")
+        file.write(f"Standard deviation of area loss ratio: {stats.std * 100:.2f}%\n")
         file.write("\n")
         
         # Write statistics of sizes
@@ -86,69 +389,57 @@ def write_statistics(directory, labels, common_sizes, loss_ratios):
             count = size_counts[size]
             # Only write sizes with a count greater than 0
             if count > 0:
-                file.write(f"{str(common_sizes[size]):<20}{count:<10,}{ratio * 100:<10.2f}\n")
+                file.write(f"{str(size):<20}{count:<10,}{ratio * 100:<10.2f}\n")
         
-        file.write("\nFiles with large loss ratio (Top 10 or >10%):\n")
-        for filename, ratio in merged_files:
+        file.write(f"\nFiles with large loss ratio (Top {stats.top_k} or >{stats.large_loss:.0%}):\n")
+        # The top files come first in descending order, the remaining spilled files follow in processing order
+        for filename, ratio in top_loss_files:
             file.write(f"File: {filename}, Loss ratio: {ratio * 100:.2f}%\n")
+        top_files = set(top_loss_files)
+        for filename, ratio in stats.large_losses():
+            if (filename, ratio) not in top_files:
+                file.write(f"File: {filename}, Loss ratio: {ratio * 100:.2f}%\n")
+
+def merge_statistics(directory, state_paths, n_sizes):
+    """Write one statistics.txt for directory from the saved aggregates of several runs.
+
+    state_paths are the {name}_statistics_{run_id}.json files written by main, one per run.
+    """
+    stats = LossAggregator.load(state_paths[0])
+    for state_path in state_paths[1:]:
+        stats.merge(LossAggregator.load(state_path))
+    write_statistics(Path(directory), stats, n_sizes)
 
 def compress_and_convert(args):
-    file, common_sizes = args
+    file, original_width, original_height = args
     try:
         img = Image.open(file)
-        max_pixels = 1088*1088
-
-        def adjust_dimensions(width, height):
-            # Ensure both dimensions are multiples of 32
-            width = (width // 32) * 32
-            height = (height // 32) * 32
-            return width, height
-
-        original_width, original_height = img.size  # Add this line to record original dimensions
-        cropped_pixels = 0  # Add this line to record the total cropped pixels
-
-        # Check if the image needs to be scaled
-        if original_width * original_height > max_pixels:
-            # Resize the image
-            img.thumbnail((1088, 1088), Image.LANCZOS)
-
-        width, height = img.size
-
-        # Check if the image needs to be cropped
-        if width * height > max_pixels:
-            # Compute the number of pixels to be removed
-            pixels_to_remove = width * height - max_pixels
-            cropped_pixels += pixels_to_remove  # Update cropped pixels if the image is being cropped
-
-            # Determine the side to be cropped
-            if width > height:
-                # Crop the width
-                reduction = (pixels_to_remove // height) * 32
-                left = reduction // 2
-                right = width - reduction // 2
-                img = img.crop((left, 0, right, height))
-            else:
-                # Crop the height
-                reduction = (pixels_to_remove // width) * 32
-                top = reduction // 2
-                bottom = height - reduction // 2
-                img = img.crop((0, top, width, bottom))
-
-            # Update the dimensions for the next iteration
-            width, height = img.size
-
-        # Adjust dimensions to be multiple of 32 by cropping
-        width, height = adjust_dimensions(width, height)
-        left = (img.width - width) // 2
-        top = (img.height - height) // 2
-        right = (img.width + width) // 2
-        bottom = (img.height + height) // 2
-
-        # Compute the number of pixels to be removed
-        pixels_to_remove = img.width * img.height - width * height
-        cropped_pixels += pixels_to_remove  # Update cropped pixels if the image is being cropped
-
-        img = img.crop((left, top, right, bottom))
+        if img.size != (original_width, original_height):
+            original_width, original_height = img.size  # The header scan and Pillow disagree, trust Pillow
+
+        # Plan the whole operation from the header dimensions: scale to fit MAX_PIXELS, then center crop to multiples of 32
+        (scaled_width, scaled_height), (width, height) = plan_size(original_width, original_height)
+        left = (scaled_width - width) // 2
+        top = (scaled_height - height) // 2
+        # Only the crop counts as loss, scaling keeps the content
+        cropped_pixels = scaled_width * scaled_height - width * height
+
+        # Let libjpeg decode at a reduced scale straight to YCbCr, keeping at least the scaled size
+        region = (0, 0, original_width, original_height)
+        if (scaled_width, scaled_height) != img.size:
+            drafted = img.draft('YCbCr', (scaled_width, scaled_height))
+            if drafted is not None:
+                region = drafted[1]
+
+        if (scaled_width, scaled_height) == img.size:
+            img = img.crop((left, top, left + width, top + height))
+        else:
+            # Map the crop rectangle back onto the decoded image and resample it in one step
+            x_scale = (region[2] - region[0]) / scaled_width
+            y_scale = (region[3] - region[1]) / scaled_height
+            box = (region[0] + left * x_scale, region[1] + top * y_scale,
+                   region[0] + (left + width) * x_scale, region[1] + (top + height) * y_scale)
+            img = img.resize((width, height), Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
 
         # Convert to 'YCbCr' and save as .jpg
         img = img.convert('YCbCr')
@@ -164,62 +455,88 @@ def compress_and_convert(args):
     except IOError:
         return None  # If the file cannot be opened as an image, skip it
 
-def remove_non_jpg_files(directory):
-    for file in directory.rglob('*'):
-        if file.suffix.lower() != '.jpg' and file.suffix.lower() != '.txt' and file.is_file():
+def _unused_target(target):
+    """Return target, or target with a _1, _2, ... stem suffix if it or its .txt already exists."""
+    candidate = target
+    for n in itertools.count(1):
+        if not candidate.exists() and not candidate.with_suffix('.txt').exists():
+            return candidate
+        candidate = target.with_name(f'{target.stem}_{n}{target.suffix}')
+
+def apply_cleanup(directory, index, removals, small_files, small_images_folder):
+    """Delete and move files in one batch once every decision has been made.
+
+    Small images keep their path relative to directory under small_images_folder, so files with the
+    same name in different subfolders never overwrite each other, and their caption .txt moves with them.
+    A target left by an earlier run is never overwritten, the moved pair gets a numbered name instead.
+    """
+    for file in small_files:
+        target = _unused_target(small_images_folder / file.relative_to(directory))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        caption = file.with_suffix('.txt')
+        for source, destination in ((file, target), (caption, target.with_suffix('.txt'))):
+            if source == caption and not caption.exists():
+                continue
+            try:
+                os.replace(source, destination)  # A rename on the same filesystem, no data is copied
+            except OSError:
+                shutil.move(str(source), str(destination))
+    for file in removals:
+        try:
             file.unlink()
+        except FileNotFoundError:
+            pass
+    index.forget(itertools.chain(small_files, removals))
 
-def remove_small_images(directory):
-    max_pixels = 0.85 * 1088 * 1088  # 计算总像素数比1088*1088小15%以上的像素数
-    for file in directory.rglob('*.jpg'):
-        with Image.open(file) as img:  # Use 'with' statement to ensure the file is properly closed
-            if imgwidth * img.height < max_pixels:
-                file.unlink()
-
-def main(directory, n_clusters):
+def main(directory, n_sizes):
     directory = Path(directory)
-    files = list(directory.rglob('*'))  # Use rglob to avoid unnecessary traversals
 
     small_images_folder = directory.parent / 'small_images'
     small_images_folder.mkdir(exist_ok=True)
+    # Keep the index next to the dataset so the cleanup below never touches it
+    index = SizeIndex(directory.parent / f'{directory.name}_size_index.sqlite')
 
+    removals = []  # Files deleted from the tree at the end
+    small_files = []  # Originals moved to small_images at the end
     with tqdm(total=2, desc="Total progress", dynamic_ncols=True) as pbar:
         with Pool(cpu_count()) as p:
-            with tqdm(total=len(files), desc='Collecting dimensions', dynamic_ncols=True) as pbar1:
-                dimensions = []
-                small_files = []  # 创建一个新列表存储小图片
-                for i, result in enumerate(p.imap_unordered(collect_dimensions, files), 1):
-                    if result is not None:
-                        dim, file = result[:-1], result[-1]  # 分离出dimension和文件路径
-                        dimensions.append(dim)
-                        # 如果文件的像素小于1088*1088的85%，则添加至small_files列表
-                        if dim[0] * dim[1] < 0.85 * 1088 * 1088:
-                            shutil.copy2(file, small_images_folder)
-                    pbar1.update()
-                pbar.update()
-        
-        dimensions = [dim for dim in dimensions if dim is not None]  # Use list comprehension
-
-        kmeans = KMeans(n_clusters=n_clusters, n_init='auto', random_state=0).fit(dimensions)
-        common_sizes = kmeans.cluster_centers_
-
+            images = []
+            rejected = []
+            for file, width, height, converted in tqdm(scan_dimensions(directory, index, p, rejected), desc='Collecting dimensions', dynamic_ncols=True):
+                # 之前的运行转换过的输出保持不变,再次运行时不会把缩小后的图像当成小图移走
+                if converted:
+                    continue
+                # 如果文件的像素小于1088*1088的85%，则不再转换，直接移动到small_images文件夹
+                if width * height < SMALL_PIXELS:
+                    small_files.append(file)
+                else:
+                    images.append((file, width, height))
+            pbar.update()
+        # 删除所有非jpg和非txt文件,包括无法读取的图像
+        removals += [file for file in rejected if file.suffix.lower() not in KEEP_SUFFIXES]
+
+        # Aggregate results as they arrive, the spill file and saved state sit next to the index.
+        # Both are named per run so the state saved by an earlier run keeps pointing at its own spill data.
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        stats = LossAggregator(directory.parent / f'{directory.name}_large_loss_{run_id}.tsv')
+        outputs = []
         with Pool(cpu_count()) as p:
-            with tqdm(total=len(files), desc='Processing images', dynamic_ncols=True) as pbar2:
-                results = list(p.imap_unordered(compress_and_convert, [(file, common_sizes) for file in files]))  # Store the results in a list first
-                loss_ratios = [(filename, ratio) for filename, ratio, _ in results if filename is not None]
-                new_dimensions = [(width, height) for _, _, (width, height) in results if width is not None]
-                pbar2.update()
-                pbar.update()
-
-        loss_ratios = [ratio for ratio in loss_ratios if ratio is not None]
-
-        write_statistics(directory, kmeans.labels_, new_dimensions, loss_ratios)  # Use new_dimensions instead of common_sizes
-
-    # 在所有图片处理完成后，删除所有非jpg和非txt文件
-    remove_non_jpg_files(directory)
-    
-    # 在所有图片处理完成后，删除像素数过小的图像
-    remove_small_images(directory)
+            for result in tqdm(p.imap_unordered(compress_and_convert, images, chunksize=16), total=len(images),
+                               desc='Processing images', dynamic_ncols=True):
+                if result is not None:
+                    stats.add(*result)
+                    outputs.append((Path(result[0]).with_suffix('.jpg'), result[2]))
+            pbar.update()
+        index.mark_converted(outputs)
+        stats.save(directory.parent / f'{directory.name}_statistics_{run_id}.json')
+        # 转换后的图像已保存为.jpg,删除其他格式的源文件
+        removals += [file for file, _, _ in images if file.suffix.lower() not in KEEP_SUFFIXES]
+
+        if stats.count:
+            write_statistics(directory, stats, n_sizes)
+
+    apply_cleanup(directory, index, removals, small_files, small_images_folder)
+    index.close()
 
 if __name__ == '__main__':
     main('your input folder', 12)
\ No newline at end of file
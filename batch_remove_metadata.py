@@ -1,32 +1,155 @@
 # coding: utf-8
+"""
+Strip metadata from PNG and JPEG files without decoding or re-encoding pixels.
+
+PNG files are rewritten chunk by chunk, dropping tEXt/iTXt/zTXt/eXIf chunks.
+JPEG files are rewritten segment by segment, dropping COM and APP1-APP15 segments
+(EXIF, XMP, Photoshop IRB, ...), except the Adobe APP14 segment, which decoders
+need to interpret the colour transform, and optionally the ICC profile in APP2.
+Everything from the start of scan onwards is copied verbatim, so the pixel data
+is byte-for-byte identical to the input.
+"""
 import os
-from PIL import Image
+import shutil
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DROPPED_PNG_CHUNKS = {b'tEXt', b'iTXt', b'zTXt', b'eXIf'}
+# Markers without a length field: TEM and RST0-RST7
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+SOS, COM, APP2, APP14 = 0xDA, 0xFE, 0xE2, 0xEE
+EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+CHUNK_SIZE = 64
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated file")
+    return data
+
+
+def strip_png(src, dst):
+    if read_exactly(src, 8) != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+    dst.write(PNG_SIGNATURE)
+    while True:
+        header = read_exactly(src, 8)
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type in DROPPED_PNG_CHUNKS:
+            src.seek(length + 4, os.SEEK_CUR)
+            continue
+        dst.write(header)
+        # Copy data and CRC in blocks so large IDAT chunks are never held in memory at once
+        remaining = length + 4
+        while remaining:
+            block = read_exactly(src, min(remaining, 1024 * 1024))
+            dst.write(block)
+            remaining -= len(block)
+        if chunk_type == b'IEND':
+            return
+
+
+def keep_jpeg_segment(marker, payload, keep_icc):
+    if marker == COM:
+        return False
+    if marker == APP14:
+        return payload.startswith(b'Adobe')
+    if marker == APP2:
+        return keep_icc and payload.startswith(b'ICC_PROFILE\x00')
+    # APP0 (JFIF) is kept, APP1-APP15 are dropped
+    return not 0xE1 <= marker <= 0xEF
+
 
-def remove_exif(image_path, output_path):
-    image = Image.open(image_path)
-    data = list(image.getdata())
-    image_without_exif = Image.new(image.mode, image.size)
-    image_without_exif.putdata(data)
-    image_without_exif.save(output_path)
+def strip_jpeg(src, dst, keep_icc=False):
+    if read_exactly(src, 2) != b'\xff\xd8':
+        raise ValueError("not a JPEG file")
+    dst.write(b'\xff\xd8')
+    while True:
+        if read_exactly(src, 1) != b'\xff':
+            raise ValueError("invalid JPEG marker")
+        marker = read_exactly(src, 1)[0]
+        # Skip fill bytes
+        while marker == 0xFF:
+            marker = read_exactly(src, 1)[0]
+        if marker in STANDALONE_MARKERS:
+            dst.write(bytes((0xFF, marker)))
+            continue
+        length_bytes = read_exactly(src, 2)
+        payload = read_exactly(src, struct.unpack('>H', length_bytes)[0] - 2)
+        if marker == SOS:
+            # Entropy-coded data and all following segments are copied untouched
+            dst.write(bytes((0xFF, marker)) + length_bytes + payload)
+            shutil.copyfileobj(src, dst)
+            return
+        if keep_jpeg_segment(marker, payload, keep_icc):
+            dst.write(bytes((0xFF, marker)) + length_bytes + payload)
 
-def process_images(input_dir, output_dir):
+
+def remove_exif(image_path, output_path, keep_icc=False):
+    """Write a copy of image_path without metadata to output_path, returning the number of bytes removed."""
+    extension = os.path.splitext(image_path)[1].lower()
+    temp_path = output_path + '.tmp'
+    try:
+        with open(image_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            if extension == '.png':
+                strip_png(src, dst)
+            else:
+                strip_jpeg(src, dst, keep_icc)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(image_path) - os.path.getsize(output_path)
+
+
+def process_chunk(tasks, keep_icc=False):
+    results = []
+    for input_path, output_path in tasks:
+        try:
+            results.append((input_path, remove_exif(input_path, output_path, keep_icc), None))
+        except Exception as e:
+            results.append((input_path, 0, str(e)))
+    return results
+
+
+def iter_tasks(input_dir, output_dir):
+    for subdir, dirs, files in os.walk(input_dir):
+        relative_dir = os.path.relpath(subdir, input_dir)
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() in EXTENSIONS:
+                target_dir = os.path.normpath(os.path.join(output_dir, relative_dir))
+                os.makedirs(target_dir, exist_ok=True)
+                yield os.path.join(subdir, filename), os.path.join(target_dir, filename)
+
+
+def process_images(input_dir, output_dir, keep_icc=False, max_workers=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith('.png'):
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, filename)
-            remove_exif(input_path, output_path)
-            print(f"Processed {filename}")
+
+    tasks = sorted(iter_tasks(input_dir, output_dir))
+    chunks = [tasks[i:i + CHUNK_SIZE] for i in range(0, len(tasks), CHUNK_SIZE)]
+    processed = errors = removed_bytes = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for results in executor.map(process_chunk, chunks, [keep_icc] * len(chunks)):
+            for input_path, removed, error in results:
+                if error is not None:
+                    print(f"Error processing {input_path}: {error}")
+                    errors += 1
+                    continue
+                processed += 1
+                removed_bytes += removed
+    print(f"Processed {processed} images, {errors} errors, removed {removed_bytes / 1024:.1f} KB of metadata")
+
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 3:
-        print("Usage: python batch_remove_metadata.py <input_directory> <output_directory>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python batch_remove_metadata.py <input_directory> <output_directory> [--keep-icc]")
         sys.exit(1)
 
     input_directory = sys.argv[1]
     output_directory = sys.argv[2]
 
-    process_images(input_directory, output_directory)
\ No newline at end of file
+    process_images(input_directory, output_directory, keep_icc=sys.argv[3:] == ['--keep-icc'])
@@ -1,54 +1,150 @@
 '''
 关键字检索txt并移动文档和对应图片
+txt 的内容保存在 SQLite FTS5 全文索引中（以路径、文件大小和修改时间为键），每次运行只重新读取新增或修改过的文件，
+查询直接在索引上进行，支持 AND/OR/NOT（二元，如 a NOT b）、"短语" 和 前缀* 查询，移动操作直接使用查询结果，不再重新扫描整个文件夹。
 '''
 import os
+import time
 import shutil
+import sqlite3
+import itertools
 from concurrent.futures import ThreadPoolExecutor
 
+IMAGE_EXTENSIONS = ['.jpg', '.png']
 
-# 定义源文件夹和目标文件夹路径
-source_folder = r''  # 示例路径，需要根据实际情况进行修改
-target_folder = r''  # 示例路径，需要根据实际情况进行修改
-keywords = ['aerial view', 'aerial']  # 添加你的关键字列表
 
-# 确保目标文件夹存在
-os.makedirs(target_folder, exist_ok=True)
+def read_caption(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read(), None
+    except Exception as e:
+        return None, e
 
-processed_files = 0
-error_files = 0
 
+class CaptionIndex:
+    '''
+    txt 内容的全文索引。files 表记录路径、大小和修改时间，captions 是 FTS5 虚拟表，rowid 与 files.id 相同。
+    '''
 
-def process_file(file_info):
-    global processed_files, error_files
-    subdir, file = file_info
-    if file.lower().endswith('.txt'):
-        file_path = os.path.join(subdir, file)
+    def __init__(self, index_path):
+        self.conn = sqlite3.connect(index_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER)')
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS captions USING fts5(text, tokenize='unicode61')")
+
+    def update(self, source_folder, chunk_size=500):
+        '''同步索引和文件夹：读取新增或修改过的 txt，删除已经不存在的文件，返回 (更新数, 删除数, 错误数)。'''
+        entries = []
+        for subdir, dirs, files in os.walk(source_folder):
+            for file in files:
+                if file.lower().endswith('.txt'):
+                    file_path = os.path.join(subdir, file)
+                    stat = os.stat(file_path)
+                    entries.append((file_path, stat.st_size, stat.st_mtime_ns))
+
+        known = {path: (image_id, size, mtime_ns) for image_id, path, size, mtime_ns
+                 in self.conn.execute('SELECT id, path, size, mtime_ns FROM files')}
+        stale = [entry for entry in entries if known.get(entry[0], (None,))[1:] != entry[1:]]
+        removed = set(known) - {entry[0] for entry in entries}
+
+        updated = errors = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            stale = iter(stale)
+            while chunk := list(itertools.islice(stale, chunk_size)):
+                for (file_path, size, mtime_ns), (content, error) in zip(chunk, executor.map(read_caption, [entry[0] for entry in chunk])):
+                    if error is not None:
+                        print(f"Error processing file {file_path}: {error}")
+                        errors += 1
+                        continue
+                    self._remove(file_path)
+                    cursor = self.conn.execute('INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)',
+                                               (file_path, size, mtime_ns))
+                    self.conn.execute('INSERT INTO captions (rowid, text) VALUES (?, ?)', (cursor.lastrowid, content))
+                    updated += 1
+                self.conn.commit()
+        for file_path in removed:
+            self._remove(file_path)
+        self.conn.commit()
+        return updated, len(removed), errors
+
+    def _remove(self, file_path):
+        row = self.conn.execute('SELECT id FROM files WHERE path = ?', (file_path,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM captions WHERE rowid = ?', row)
+            self.conn.execute('DELETE FROM files WHERE id = ?', row)
+
+    def remove(self, paths):
+        for file_path in paths:
+            self._remove(file_path)
+        self.conn.commit()
+
+    def search(self, query):
+        '''
+        用 FTS5 查询语法检索，返回匹配的 (txt 路径, 图片路径或 None)。
+        例如 '"aerial view" OR aerial'、'aerial NOT night'、'aeria*'，大小写不敏感。
+        '''
+        matches = []
+        for file_path, in self.conn.execute('SELECT files.path FROM captions JOIN files ON files.id = captions.rowid '
+                                            'WHERE captions MATCH ? ORDER BY files.path', (query,)):
+            base_name = os.path.splitext(file_path)[0]
+            image_path = next((base_name + ext for ext in IMAGE_EXTENSIONS if os.path.exists(base_name + ext)), None)
+            matches.append((file_path, image_path))
+        return matches
+
+    def close(self):
+        self.conn.close()
+
+
+def keywords_query(keywords):
+    '''
+    把关键字列表转成 FTS5 查询：任意一个关键字（作为短语，最后一个词按前缀匹配）出现即匹配。
+    例如 aerial 可以匹配 aerials、aerially，但与原来的子串匹配不同，不会匹配出现在单词中间的关键字（rial 不匹配 aerial）。
+    '''
+    return ' OR '.join('"{}"*'.format(keyword.replace('"', '""')) for keyword in keywords)
+
+
+def move_matches(index, matches, source_folder, target_folder):
+    '''把查询结果中的 txt 和对应图片移动到目标文件夹（保持相对路径），并从索引中删除，返回 (移动数, 错误数)。'''
+    moved_files = 0
+    error_files = 0
+    moved = []
+    for file_path, image_path in matches:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                file_content = f.read().lower()
-                if any(keyword.lower() in file_content for keyword in keywords):
-                    relative_dir = os.path.relpath(subdir, source_folder)
-                    target_subdir = os.path.join(target_folder, relative_dir)
-                    os.makedirs(target_subdir, exist_ok=True)
-
-                    shutil.move(file_path, os.path.join(target_subdir, os.path.basename(file)))
-
-                    base_name = os.path.splitext(file)[0]
-                    for img_ext in ['.jpg', '.png']:
-                        img_file = base_name + img_ext
-                        img_path = os.path.join(subdir, img_file)
-                        if os.path.exists(img_path):
-                            shutil.move(img_path, os.path.join(target_subdir, img_file))
-                            processed_files += 1
-                            break
+            relative_dir = os.path.relpath(os.path.dirname(file_path), source_folder)
+            target_subdir = os.path.join(target_folder, relative_dir)
+            os.makedirs(target_subdir, exist_ok=True)
+            shutil.move(file_path, os.path.join(target_subdir, os.path.basename(file_path)))
+            moved.append(file_path)
+            if image_path is not None:
+                shutil.move(image_path, os.path.join(target_subdir, os.path.basename(image_path)))
+                moved_files += 1
         except Exception as e:
             print(f"Error processing file {file_path}: {e}")
             error_files += 1
+    index.remove(moved)
+    return moved_files, error_files
+
+
+if __name__ == "__main__":
+    # 定义源文件夹和目标文件夹路径
+    source_folder = r''  # 示例路径，需要根据实际情况进行修改
+    target_folder = r''  # 示例路径，需要根据实际情况进行修改
+    keywords = ['aerial view', 'aerial']  # 添加你的关键字列表，按单词前缀匹配，不匹配单词中间的子串
+    # 也可以直接写 FTS5 查询，例如 query = '"aerial view" NOT night'
+    query = keywords_query(keywords)
 
-all_files = [(subdir, file) for subdir, dirs, files in os.walk(source_folder) for file in files if file.endswith('.txt')]
+    # 确保目标文件夹存在
+    os.makedirs(target_folder, exist_ok=True)
 
+    start_time = time.time()
+    index = CaptionIndex(os.path.join(source_folder, '_caption_index.sqlite'))
+    updated, removed, errors = index.update(source_folder)
+    print(f'索引已更新：{updated} 个新增或修改的文件，{removed} 个已删除的文件，{errors} 个错误，耗时 {time.time() - start_time:.2f} 秒。')
 
-with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-    executor.map(process_file, all_files)
+    start_time = time.time()
+    matches = index.search(query)
+    print(f'查询 {query} 找到 {len(matches)} 个文件，耗时 {time.time() - start_time:.3f} 秒。')
 
-print(f'完成，共处理{processed_files}个文件，遇到{error_files}个错误。')
+    processed_files, error_files = move_matches(index, matches, source_folder, target_folder)
+    index.close()
+    print(f'完成，共处理{processed_files}个文件，遇到{error_files + errors}个错误。')
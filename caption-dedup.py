@@ -0,0 +1,212 @@
+'''
+找出内容几乎相同的 txt 标注（打标模型对不同图片返回的同一套模板话）。
+每个 txt 按单词切成 SHINGLE_SIZE 个单词的片段，在进程池中计算 MinHash 签名；
+签名按局部敏感哈希（LSH）分成若干段，至少有一段完全相同的才作为候选对，不需要两两比较。
+候选对用签名估计 Jaccard 相似度，打印各个阈值下的重复对数，超过阈值的用并查集合并成簇，
+结果写入 _duplicates/caption_clusters.txt；move=True 时每簇保留路径排序最前的一个，其余的 txt 和对应图片移动到 _duplicates。
+'''
+import os
+import re
+import time
+import shutil
+import zlib
+import itertools
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
+SKIPPED_FOLDERS = {'_duplicates', 'error'}
+TOKEN_PATTERN = re.compile(r'\w+')
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+SEED = 1
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+CHUNK_SIZE = 256
+# 同一个桶中的文件超过这个数时不再两两比较，只和桶中第一个文件比较（大量相同的模板话会落在同一个桶中）
+MAX_BUCKET_PAIRS = 1000
+REPORT_THRESHOLDS = (0.7, 0.8, 0.9, 1.0)
+
+
+def permutations(num_perm=NUM_PERM, seed=SEED):
+    '''所有进程使用同一组随机排列 (a, b)，签名才可以比较。'''
+    generator = np.random.RandomState(seed)
+    a = generator.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = generator.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    words = TOKEN_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(shingle_set, a, b):
+    '''对片段的 32 位哈希值做 (a * x + b) mod p 的随机排列，取每个排列下的最小值。'''
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set),
+                         dtype=np.uint64, count=len(shingle_set))
+    permuted = ((hashes[:, None] * a + b) % MERSENNE_PRIME) & MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def signature_chunk(paths, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE):
+    '''计算一批 txt 的签名，返回 (path, 签名或 None)；读取失败或没有单词的 txt 签名为 None。'''
+    a, b = permutations(num_perm)
+    results = []
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                shingle_set = shingles(f.read(), shingle_size)
+        except Exception as e:
+            print(f"Error processing file {path}: {e}")
+            shingle_set = set()
+        results.append((path, minhash(shingle_set, a, b) if shingle_set else None))
+    return results
+
+
+def list_captions(folder):
+    paths = []
+    for subdir, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_FOLDERS]
+        paths.extend(os.path.join(subdir, file) for file in files if file.lower().endswith('.txt'))
+    return sorted(paths)
+
+
+def compute_signatures(paths, num_perm=NUM_PERM, max_workers=None, chunk_size=CHUNK_SIZE):
+    '''用进程池计算签名，返回 (有签名的路径列表, 签名矩阵)。'''
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    kept, signatures = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for results in executor.map(signature_chunk, chunks, itertools.repeat(num_perm)):
+            for path, signature in results:
+                if signature is not None:
+                    kept.append(path)
+                    signatures.append(signature)
+    return kept, np.array(signatures, dtype=np.uint32).reshape(len(signatures), num_perm)
+
+
+def choose_bands(num_perm, threshold):
+    '''
+    选择段数 bands（每段 num_perm // bands 行）。两个签名成为候选对的概率在相似度约 (1 / bands) ** (1 / rows) 处陡增，
+    选不超过 threshold 且最接近它的，尽量不漏掉超过阈值的对。
+    '''
+    options = [bands for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [bands for bands in options if (1 / bands) ** (bands / num_perm) <= threshold]
+    return min(below or options, key=lambda bands: threshold - (1 / bands) ** (bands / num_perm))
+
+
+def candidate_pairs(signatures, bands):
+    '''把签名分成 bands 段，每段完全相同的签名落在同一个桶中，同一个桶中的签名两两成为候选对。'''
+    rows = signatures.shape[1] // bands
+    pairs = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for position, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[key.tobytes()].append(position)
+        for members in buckets.values():
+            if len(members) > MAX_BUCKET_PAIRS:
+                pairs.update((members[0], member) for member in members[1:])
+            elif len(members) > 1:
+                pairs.update(itertools.combinations(members, 2))
+    return pairs
+
+
+def estimate_similarities(signatures, pairs):
+    '''用签名中相同位置值相等的比例估计 Jaccard 相似度，返回 (i 数组, j 数组, 相似度数组)。'''
+    if not pairs:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+    i, j = np.array(sorted(pairs), dtype=np.int64).T
+    similarities = np.empty(len(i))
+    # 分块比较，避免候选对很多时一次生成巨大的中间矩阵
+    for start in range(0, len(i), 100000):
+        block = slice(start, start + 100000)
+        similarities[block] = (signatures[i[block]] == signatures[j[block]]).mean(axis=1)
+    return i, j, similarities
+
+
+def cluster_pairs(n, pairs):
+    '''用并查集把重复的 txt 对合并成簇，返回包含两个以上 txt 的簇。'''
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+
+    clusters = defaultdict(list)
+    for i in range(n):
+        clusters[find(i)].append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def move_duplicates(clusters, paths, folder, duplicate_folder):
+    '''每簇保留路径排序最前的 txt，其余的 txt 和对应图片移动到重复文件夹，返回移动的 txt 数。'''
+    moved = 0
+    for members in clusters:
+        for position in sorted(members)[1:]:
+            txt_path = paths[position]
+            base_name = os.path.splitext(txt_path)[0]
+            # 不同子文件夹中可能有同名文件，用相对路径作为文件名
+            prefix = os.path.relpath(base_name, folder).replace(os.sep, '_')
+            for path in [txt_path] + [base_name + ext for ext in IMAGE_EXTENSIONS if os.path.exists(base_name + ext)]:
+                shutil.move(path, os.path.join(duplicate_folder, prefix + os.path.splitext(path)[1]))
+            moved += 1
+    return moved
+
+
+def find_duplicates(folder, threshold=0.8, num_perm=NUM_PERM, move=False, max_workers=None):
+    start_time = time.time()
+    duplicate_folder = os.path.join(folder, '_duplicates')
+    os.makedirs(duplicate_folder, exist_ok=True)
+
+    paths = list_captions(folder)
+    print(f'共 {len(paths)} 个 txt，开始计算 MinHash 签名...')
+    paths, signatures = compute_signatures(paths, num_perm, max_workers)
+    print(f'计算签名耗时 {time.time() - start_time:.2f} 秒。')
+
+    bands = choose_bands(num_perm, min(threshold, *REPORT_THRESHOLDS))
+    pairs = candidate_pairs(signatures, bands)
+    i, j, similarities = estimate_similarities(signatures, pairs)
+    print(f'LSH 分成 {bands} 段，找到 {len(pairs)} 个候选对（两两比较需要 {len(paths) * (len(paths) - 1) // 2} 对）。')
+    for report_threshold in sorted(set(REPORT_THRESHOLDS) | {threshold}):
+        matched = similarities >= report_threshold
+        clusters = cluster_pairs(len(paths), zip(i[matched], j[matched]))
+        print(f'Jaccard >= {report_threshold:.2f}: {int(matched.sum())} 对，{len(clusters)} 组，'
+              f'{sum(len(members) - 1 for members in clusters)} 个重复的 txt')
+
+    matched = similarities >= threshold
+    clusters = cluster_pairs(len(paths), zip(i[matched], j[matched]))
+    best = defaultdict(float)
+    for a, b, similarity in zip(i[matched], j[matched], similarities[matched]):
+        best[b] = max(best[b], similarity)
+        best[a] = max(best[a], similarity)
+    with open(os.path.join(duplicate_folder, 'caption_clusters.txt'), 'w', encoding='utf-8') as report:
+        for members in clusters:
+            members = sorted(members)
+            report.write(f'保留: {paths[members[0]]}\n')
+            for position in members[1:]:
+                report.write(f'    重复: {paths[position]} (最高相似度 {best[position]:.2f})\n')
+
+    moved = move_duplicates(clusters, paths, folder, duplicate_folder) if move else 0
+    print(f'处理完成。Jaccard 阈值 {threshold}，找到 {len(clusters)} 组重复的 txt，移动了 {moved} 个，'
+          f'总耗时 {time.time() - start_time:.2f} 秒。')
+
+
+if __name__ == "__main__":
+    folder = 'your input folder'
+    # 估计的 Jaccard 相似度阈值，1.0 表示片段完全相同
+    threshold = 0.8
+
+    find_duplicates(folder, threshold=threshold)
+    # 确认报告后移动重复的 txt 和图片：
+    # find_duplicates(folder, threshold=threshold, move=True)
@@ -0,0 +1,103 @@
+'''
+打标结果的本地缓存，以 (图片内容的 sha256, 模型名, 提示词) 为键，glm4-tagging.py 和 geminipro-cap.py 共用。
+同一张图片（包括改名或加了前缀的副本）用同样的模型和提示词打过标后，再次遇到时直接返回缓存的结果，不再调用 API。
+缓存条目数超过上限时按最近使用时间淘汰；可以导出为 JSONL 或从 JSONL 导入，在机器之间共享。
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# 默认的缓存位置，放在用户目录下，所有数据集共用
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.caption_cache.sqlite')
+MAX_ENTRIES = 1_000_000
+# 每写入这么多条检查一次表中的实际条目数；打开和关闭缓存时也会检查
+EVICT_EVERY = 1000
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CaptionCache:
+    '''
+    保存在 SQLite 中的打标结果缓存。每个进程各自打开一个实例；多个进程共用同一个文件时靠 WAL 和锁等待保证安全。
+    '''
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(cache_path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS captions ('
+                          'image_hash TEXT, model TEXT, prompt TEXT, caption TEXT, created REAL, last_used REAL, '
+                          'PRIMARY KEY (image_hash, model, prompt))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)')
+        self.conn.commit()
+        self.puts = 0
+        # 条目数以表中的实际行数为准，每次运行写入很少的进程也能保证不超过上限
+        self.evict()
+
+    def get(self, image_hash, model, prompt):
+        '''返回缓存的打标结果并更新使用时间，没有时返回 None。'''
+        row = self.conn.execute('SELECT caption FROM captions WHERE image_hash = ? AND model = ? AND prompt = ?',
+                                (image_hash, model, prompt)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute('UPDATE captions SET last_used = ? WHERE image_hash = ? AND model = ? AND prompt = ?',
+                          (time.time(), image_hash, model, prompt))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, image_hash, model, prompt, caption):
+        now = time.time()
+        self.conn.execute('INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?, ?)',
+                          (image_hash, model, prompt, caption, now, now))
+        self.conn.commit()
+        self.puts += 1
+        # 不必每次写入都检查条目数
+        if self.puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        '''条目数超过上限时删除最久没有使用的条目，返回删除的数量。'''
+        count = self.conn.execute('SELECT COUNT(*) FROM captions').fetchone()[0]
+        if count <= self.max_entries:
+            return 0
+        self.conn.execute('DELETE FROM captions WHERE rowid IN '
+                          '(SELECT rowid FROM captions ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+        self.conn.commit()
+        return count - self.max_entries
+
+    def export_jsonl(self, path):
+        '''导出所有条目，返回条目数。'''
+        count = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for image_hash, model, prompt, caption, created, last_used in self.conn.execute(
+                    'SELECT image_hash, model, prompt, caption, created, last_used FROM captions'):
+                f.write(json.dumps({'image_hash': image_hash, 'model': model, 'prompt': prompt, 'caption': caption,
+                                    'created': created, 'last_used': last_used}, ensure_ascii=False) + '\n')
+                count += 1
+        return count
+
+    def import_jsonl(self, path):
+        '''导入条目，已经存在的键保留本地的结果，返回新增的条目数。'''
+        before = self.conn.total_changes
+        with open(path, 'r', encoding='utf-8') as f:
+            rows = (json.loads(line) for line in f if line.strip())
+            self.conn.executemany('INSERT OR IGNORE INTO captions VALUES (?, ?, ?, ?, ?, ?)',
+                                  ((row['image_hash'], row['model'], row['prompt'], row['caption'],
+                                    row.get('created', time.time()), row.get('last_used', time.time()))
+                                   for row in rows))
+        self.conn.commit()
+        self.evict()
+        return self.conn.total_changes - before
+
+    def close(self):
+        if self.puts:
+            self.evict()
+        self.conn.close()
@@ -1,41 +1,99 @@
 '''
 从特定目录下的Parquet文件中提取图像和文本数据，并将它们分别保存为JPEG和TXT文件。
+目录下所有的 .parquet 分片按文件名排序，用 pyarrow 按记录批次流式读取，内存占用只与批次大小有关，与分片大小无关。
+每个批次交给进程池解码和写入，同时等待的批次数量有上限；已经是 JPEG 的数据原样写入，不重新编码。
 '''
 import os
-import pandas as pd
-from PIL import Image
 import io
+import glob
+import time
+import pyarrow.parquet as pq
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# 每个记录批次的行数
+BATCH_SIZE = 256
+JPEG_MAGIC = b'\xff\xd8\xff'
+
 
-parquet_directory = 'your input folder'
-output_directory = 'your output folder'
-
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-
-for i in range(7):
-    file_path = os.path.join(parquet_directory, f'train-0000{i}-of-00007.parquet')
-    
-    df = pd.read_parquet(file_path)
-    
-    for index, row in df.iterrows():
-        image_data = row['image']  # 图片数据在'image'列中
-        caption = row['caption']   # 文本数据在'caption'列中
-        
-        if isinstance(image_data, dict) and 'bytes' in image_data:
+def extract_batch(shard_number, start_index, batch, output_directory):
+    '''把一个记录批次写成 image_{分片序号}_{行号}.jpg/.txt，返回 (原样写入数, 重新编码数, 跳过数)。'''
+    copied = reencoded = skipped = 0
+    images = batch.column('image').to_pylist()  # 图片数据在'image'列中
+    captions = batch.column('caption').to_pylist()  # 文本数据在'caption'列中
+    for offset, (image_data, caption) in enumerate(zip(images, captions)):
+        index = start_index + offset
+        if isinstance(image_data, dict) and image_data.get('bytes'):
             image_bytes = image_data['bytes']
         else:
             print(f"Skipping index {index}: image data is not in the expected format.")
+            skipped += 1
             continue
-        
-        image = Image.open(io.BytesIO(image_bytes))
-        image_filename = f'image_{i}_{index}.jpg'  # 修改文件扩展名为.jpg
-        image_path = os.path.join(output_directory, image_filename)
-        
-        image.save(image_path, format='JPEG', quality=100)
-        
-        text_filename = f'image_{i}_{index}.txt'
-        text_path = os.path.join(output_directory, text_filename)
+
+        image_path = os.path.join(output_directory, f'image_{shard_number}_{index}.jpg')
+        if image_bytes[:3] == JPEG_MAGIC:
+            # 已经是 JPEG，直接写入原始字节
+            with open(image_path, 'wb') as image_file:
+                image_file.write(image_bytes)
+            copied += 1
+        else:
+            try:
+                image = Image.open(io.BytesIO(image_bytes))
+                if image.mode not in ('RGB', 'L', 'CMYK'):
+                    image = image.convert('RGB')
+                image.save(image_path, format='JPEG', quality=100)
+            except Exception as e:
+                print(f"Skipping index {index}: {e}")
+                skipped += 1
+                continue
+            reencoded += 1
+
+        text_path = os.path.join(output_directory, f'image_{shard_number}_{index}.txt')
         with open(text_path, 'w', encoding='utf-8') as text_file:
-            text_file.write(caption)
+            text_file.write(caption or '')
+    return copied, reencoded, skipped
+
+
+def iter_batches(parquet_directory, batch_size):
+    '''按文件名顺序流式读取所有分片，生成 (分片序号, 批次第一行的行号, 记录批次)。'''
+    for shard_number, file_path in enumerate(sorted(glob.glob(os.path.join(parquet_directory, '*.parquet')))):
+        print(f"正在读取 {file_path}")
+        start_index = 0
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=batch_size, columns=['image', 'caption']):
+            yield shard_number, start_index, batch
+            start_index += batch.num_rows
+
+
+def extract_all(parquet_directory, output_directory, batch_size=BATCH_SIZE, max_workers=None):
+    start_time = time.time()
+    os.makedirs(output_directory, exist_ok=True)
+
+    totals = [0, 0, 0]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # 同时等待的批次数量有上限，读取不会跑到写入前面太远
+        max_pending = (max_workers or os.cpu_count() or 1) * 2
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                for i, count in enumerate(future.result()):
+                    totals[i] += count
+
+        for shard_number, start_index, batch in iter_batches(parquet_directory, batch_size):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(extract_batch, shard_number, start_index, batch, output_directory))
+        collect(pending)
+
+    copied, reencoded, skipped = totals
+    elapsed_time = time.time() - start_time
+    written = copied + reencoded
+    print(f"所有文件已提取并保存。共 {written} 张图像（原样写入 {copied} 张，重新编码 {reencoded} 张），"
+          f"跳过 {skipped} 条，耗时 {elapsed_time:.2f} 秒（{written / max(elapsed_time, 1e-9):.1f} 张/秒）。")
+
 
-print("所有文件已提取并保存。")
\ No newline at end of file
+if __name__ == "__main__":
+    parquet_directory = 'your input folder'
+    output_directory = 'your output folder'
+    extract_all(parquet_directory, output_directory)
@@ -0,0 +1,239 @@
+'''
+把散落的 .jpg + .txt 图像/标注对打包成固定大小的 tar 分片（WebDataset 格式，每个样本是 {key}.jpg 和 {key}.txt 两个成员），
+并生成紧凑的二进制偏移索引，可以用 mmap 按键随机读取任意样本，是 dataset-unparquet.py 的反向操作。
+打包时先按文件大小规划好每个分片包含的样本，再用进程池并行写入各个分片。
+输出目录中的文件：
+    shard-000000.tar ...   分片
+    index.json             分片文件名和样本数
+    index.bin              按键排序的定长记录（分片序号、图像和标注在分片中的偏移与长度、键的位置）
+    keys.bin               所有键的 UTF-8 字节，按记录顺序首尾相接
+其他脚本可以 import dataset_shards，用 ShardReader 遍历或按键读取样本。
+'''
+import os
+import json
+import mmap
+import tarfile
+import time
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# 每个分片的目标大小
+SHARD_BYTES = 1024 * 1024 * 1024
+INDEX_DTYPE = np.dtype([
+    ('shard', '<u4'),
+    ('image_offset', '<u8'),
+    ('image_size', '<u8'),
+    ('caption_offset', '<u8'),
+    ('caption_size', '<u4'),
+    ('key_offset', '<u8'),
+    ('key_size', '<u4'),
+])
+
+
+def list_samples(input_directory):
+    '''返回所有 (key, 图像路径, 标注路径或 None, 字节数)，key 是去掉扩展名的相对路径，按键排序。'''
+    samples = []
+    for dirpath, dirnames, filenames in os.walk(input_directory):
+        dirnames.sort()
+        names = set(filenames)
+        for filename in sorted(filenames):
+            stem, extension = os.path.splitext(filename)
+            if extension.lower() != '.jpg':
+                continue
+            image_path = os.path.join(dirpath, filename)
+            caption_path = os.path.join(dirpath, stem + '.txt') if stem + '.txt' in names else None
+            key = os.path.relpath(os.path.join(dirpath, stem), input_directory).replace(os.sep, '/')
+            size = os.path.getsize(image_path) + (os.path.getsize(caption_path) if caption_path else 0)
+            samples.append((key, image_path, caption_path, size))
+    samples.sort()
+    return samples
+
+
+def check_unique_keys(samples):
+    '''
+    key 相同的样本（例如大小写不同的 x.jpg 和 x.JPG）会写出同名的 tar 成员，索引只能找到其中一个，
+    所以发现重复的 key 时抛出 ValueError，列出冲突的文件，由用户重命名后再打包。
+    '''
+    paths = defaultdict(list)
+    for key, image_path, _, _ in samples:
+        paths[key].append(image_path)
+    duplicates = {key: image_paths for key, image_paths in paths.items() if len(image_paths) > 1}
+    if duplicates:
+        examples = '; '.join(f'{key}: {", ".join(image_paths)}' for key, image_paths in sorted(duplicates.items())[:10])
+        raise ValueError(f'{len(duplicates)} 个 key 对应多个文件，请重命名后再打包: {examples}')
+
+
+def plan_shards(samples, shard_bytes):
+    '''按累计大小把样本切成若干分片，每个分片不超过 shard_bytes（单个样本更大时独占一个分片）。key 不能重复。'''
+    check_unique_keys(samples)
+    shards, current, current_bytes = [], [], 0
+    for sample in samples:
+        # 每个 tar 成员至少有 512 字节的头和对齐
+        size = sample[3] + 2048
+        if current and current_bytes + size > shard_bytes:
+            shards.append(current)
+            current, current_bytes = [], 0
+        current.append(sample)
+        current_bytes += size
+    if current:
+        shards.append(current)
+    return shards
+
+
+def write_shard(shard_path, samples):
+    '''写入一个 tar 分片，返回每个样本的 (key, image_offset, image_size, caption_offset, caption_size)。'''
+    with tarfile.open(shard_path + '.tmp', 'w', format=tarfile.PAX_FORMAT) as tar:
+        for key, image_path, caption_path, _ in samples:
+            tar.add(image_path, arcname=key + '.jpg', recursive=False)
+            if caption_path:
+                tar.add(caption_path, arcname=key + '.txt', recursive=False)
+
+    # 再读一遍成员头，得到每个成员的数据在分片中的偏移
+    members = {}
+    with tarfile.open(shard_path + '.tmp', 'r') as tar:
+        for member in tar:
+            members[member.name] = (member.offset_data, member.size)
+    os.replace(shard_path + '.tmp', shard_path)
+
+    records = []
+    for key, _, caption_path, _ in samples:
+        image_offset, image_size = members[key + '.jpg']
+        caption_offset, caption_size = members[key + '.txt'] if caption_path else (0, 0)
+        records.append((key, image_offset, image_size, caption_offset, caption_size))
+    return records
+
+
+def write_index(output_directory, shard_names, shard_records):
+    '''把所有分片的记录按键排序后写入 index.bin、keys.bin 和 index.json。'''
+    rows = sorted((key, shard) + tuple(values)
+                  for shard, records in enumerate(shard_records)
+                  for key, *values in records)
+    index = np.zeros(len(rows), dtype=INDEX_DTYPE)
+    key_offset = 0
+    with open(os.path.join(output_directory, 'keys.bin'), 'wb') as keys_file:
+        for i, (key, shard, image_offset, image_size, caption_offset, caption_size) in enumerate(rows):
+            key_bytes = key.encode('utf-8')
+            keys_file.write(key_bytes)
+            index[i] = (shard, image_offset, image_size, caption_offset, caption_size, key_offset, len(key_bytes))
+            key_offset += len(key_bytes)
+    index.tofile(os.path.join(output_directory, 'index.bin'))
+    with open(os.path.join(output_directory, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'shards': shard_names, 'count': len(rows)}, f, ensure_ascii=False, indent=2)
+
+
+def pack_dataset(input_directory, output_directory, shard_bytes=SHARD_BYTES, max_workers=None):
+    start_time = time.time()
+    os.makedirs(output_directory, exist_ok=True)
+
+    samples = list_samples(input_directory)
+    shards = plan_shards(samples, shard_bytes)
+    shard_names = [f'shard-{i:06d}.tar' for i in range(len(shards))]
+    print(f'共 {len(samples)} 个样本，打包为 {len(shards)} 个分片...')
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        shard_records = list(executor.map(write_shard,
+                                          [os.path.join(output_directory, name) for name in shard_names],
+                                          shards))
+    write_index(output_directory, shard_names, shard_records)
+
+    total_bytes = sum(sample[3] for sample in samples)
+    elapsed_time = time.time() - start_time
+    print(f'打包完成。{len(samples)} 个样本，{total_bytes / 1024 ** 2:.1f} MB，'
+          f'耗时 {elapsed_time:.2f} 秒（{len(samples) / max(elapsed_time, 1e-9):.1f} 个/秒）。')
+
+
+def map_file(path):
+    '''只读 mmap 整个文件，空文件返回 b''。'''
+    if not os.path.getsize(path):
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ShardReader:
+    '''
+    按索引读取打包好的数据集。分片和索引都用 mmap 打开，只有实际读取的页面才会进入内存。
+    reader[key] 返回 (图像字节, 标注文本)，iter 按分片顺序返回 (key, 图像字节, 标注文本)。
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.shard_names = meta['shards']
+        self.index = np.memmap(os.path.join(directory, 'index.bin'), dtype=INDEX_DTYPE, mode='r') \
+            if meta['count'] else np.zeros(0, dtype=INDEX_DTYPE)
+        self.keys = map_file(os.path.join(directory, 'keys.bin'))
+        self.shards = {}
+
+    def _shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = map_file(os.path.join(self.directory, self.shard_names[shard]))
+        return self.shards[shard]
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, i):
+        record = self.index[i]
+        return self.keys[record['key_offset']:record['key_offset'] + record['key_size']].decode('utf-8')
+
+    def read(self, i):
+        '''按记录序号返回 (key, 图像字节, 标注文本)。'''
+        shard, image_offset, image_size, caption_offset, caption_size, _, _ = self.index[i].tolist()
+        data = self._shard(shard)
+        image_bytes = data[image_offset:image_offset + image_size]
+        caption = data[caption_offset:caption_offset + caption_size].decode('utf-8')
+        return self.key(i), image_bytes, caption
+
+    def find(self, key):
+        '''在按键排序的记录中二分查找，返回记录序号，找不到时返回 None。'''
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.key(low) == key:
+            return low
+        return None
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.read(i)[1:]
+
+    def __iter__(self):
+        # 按分片和偏移的顺序读取，顺序访问磁盘
+        order = np.lexsort((self.index['image_offset'], self.index['shard']))
+        for i in order:
+            yield self.read(int(i))
+
+    def close(self):
+        for data in list(self.shards.values()) + [self.keys]:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.shards.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    input_directory = 'your input folder'
+    output_directory = 'your output folder'
+    pack_dataset(input_directory, output_directory)
+
+    # 读取示例：
+    # with ShardReader(output_directory) as reader:
+    #     for key, image_bytes, caption in reader:
+    #         ...
@@ -1,7 +1,21 @@
+'''
+用 Gemini 给文件夹中的图片打标，结果保存为同名 txt 文件。
+每张图片的状态（pending/running/done/failed）和尝试次数记录在输出文件夹的 SQLite 任务表 _caption_jobs.sqlite 中，
+中断后重新运行会从中断的地方继续，失败的图片可以按尝试次数和错误信息有选择地重试。
+多个工作进程用 BEGIN IMMEDIATE 事务领取任务，同一张图片不会被重复处理。
+主进程在另一个进程池中按领取的顺序提前预处理 pending 的图片，工作进程上传时直接使用缓存的结果，预处理与网络请求重叠。
+内容相同的图片用同样的模型和提示词打过标时直接使用 caption_cache 中的结果，不再调用 API。
+'''
 import os
-import PIL.Image
+import time
+import socket
+import sqlite3
+import shutil
 import google.generativeai as genai
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+import upload_prep
+import caption_cache
 
 api_key = 'your api key' # https://makersuite.google.com/app/apikey
 
@@ -10,17 +24,17 @@ OUTPUT_FOLDER = 'your output folder'
 
 image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
 cap_extension = ".txt"
-Processed = 0
 query = "describe the picture."
-
-if not os.path.exists(OUTPUT_FOLDER):
-    os.makedirs(OUTPUT_FOLDER)
-
-image_files = [os.path.join(IMAGE_FOLDER, f) for f in os.listdir(IMAGE_FOLDER) if
-               os.path.splitext(f)[1].lower() in image_extensions]
-
-
-genai.configure(api_key=api_key)
+MODEL_NAME = 'gemini-pro-vision'
+# 工作进程数
+WORKERS = 4
+# 提前预处理图片的进程数
+PREPARE_WORKERS = 2
+# 失败的图片最多尝试的次数
+MAX_ATTEMPTS = 3
+# 其他机器上的工作进程领取的任务，running 状态超过这么多秒没有更新，认为领取它的进程已经退出，重新放回 pending；
+# 本机的工作进程是否还在运行可以直接检查，不需要等待
+STALE_SECONDS = 600
 
 # safety_settings = [
 #     {'category': 'HARM_CATEGORY_SEXUALLY_EXPLICIT', 'threshold': 'BLOCK_NONE'},
@@ -37,31 +51,225 @@ genai.configure(api_key=api_key)
 #     'top_k': None,
 # }
 
-# model = genai.GenerativeModel(model_name='gemini-pro-vision', safety_settings=safety_settings,
-#     generation_config=generation_config)
-model = genai.GenerativeModel('gemini-pro-vision')
 
-Processing = 0
+def make_model():
+    genai.configure(api_key=api_key)
+    # return genai.GenerativeModel(model_name=MODEL_NAME, safety_settings=safety_settings,
+    #     generation_config=generation_config)
+    return genai.GenerativeModel(MODEL_NAME)
+
+
+def pid_alive(pid):
+    '''本机上 pid 对应的进程是否还在运行。Windows 上 os.kill 会结束进程，不能用来检查。'''
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        # STILL_ACTIVE
+        return exit_code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 
-for image_file in tqdm(image_files, desc="Processing images"):
-    Processing = Processing + 1
-    if Processing >= Processed:
+class JobLedger:
+    '''
+    保存在 SQLite 中的打标任务表，每张图片一行：状态、尝试次数、最后的错误、领取它的进程和更新时间。
+    '''
+
+    def __init__(self, ledger_path):
+        # 多个进程同时写入时等待锁，而不是立即报错
+        self.conn = sqlite3.connect(ledger_path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                          'path TEXT PRIMARY KEY, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                          'error TEXT, worker TEXT, updated REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, path)')
+
+    def add(self, image_files, output_folder):
+        '''登记新图片，已经有 txt 的直接记为 done；已经登记过的图片保持原来的状态。'''
+        rows = []
+        for image_file in image_files:
+            output_file_path = os.path.join(output_folder, os.path.splitext(os.path.basename(image_file))[0] + cap_extension)
+            rows.append((image_file, 'done' if os.path.exists(output_file_path) else 'pending', time.time()))
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT OR IGNORE INTO jobs (path, state, updated) VALUES (?, ?, ?)', rows)
+        self.conn.execute('COMMIT')
+
+    def reset_stale(self, stale_seconds=STALE_SECONDS):
+        '''
+        把领取它的进程已经退出的 running 任务放回 pending，返回数量。
+        本机的进程检查 pid 是否还在运行，崩溃或 Ctrl-C 之后重新运行可以立即恢复；其他机器的进程只能按 stale_seconds 超时判断。
+        '''
+        hostname = socket.gethostname()
+        stale = []
+        for path, worker, updated in self.conn.execute("SELECT path, worker, updated FROM jobs WHERE state = 'running'"):
+            host, _, pid = (worker or '').rpartition(':')
+            if host == hostname and pid.isdigit():
+                if not pid_alive(int(pid)):
+                    stale.append(path)
+            elif updated is None or updated < time.time() - stale_seconds:
+                stale.append(path)
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany("UPDATE jobs SET state = 'pending', worker = NULL WHERE path = ? AND state = 'running'",
+                              [(path,) for path in stale])
+        self.conn.execute('COMMIT')
+        return len(stale)
+
+    def retry_failed(self, max_attempts=MAX_ATTEMPTS, error_contains=None):
+        '''把尝试次数少于 max_attempts 的 failed 任务放回 pending；error_contains 不为 None 时只重试错误信息包含它的任务。'''
+        sql = "UPDATE jobs SET state = 'pending' WHERE state = 'failed' AND attempts < ?"
+        params = [max_attempts]
+        if error_contains is not None:
+            sql += ' AND error LIKE ?'
+            params.append(f'%{error_contains}%')
+        return self.conn.execute(sql, params).rowcount
+
+    def claim(self, worker):
+        '''原子地领取一个 pending 任务并标记为 running，没有任务时返回 None。'''
+        self.conn.execute('BEGIN IMMEDIATE')
         try:
-            img = PIL.Image.open(image_file)
+            row = self.conn.execute("SELECT path FROM jobs WHERE state = 'pending' ORDER BY path LIMIT 1").fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, updated = ? "
+                                  "WHERE path = ?", (worker, time.time(), row[0]))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return row[0] if row else None
+
+    def finish(self, image_file, error=None):
+        self.conn.execute('UPDATE jobs SET state = ?, error = ?, worker = NULL, updated = ? WHERE path = ?',
+                          ('done' if error is None else 'failed', error, time.time(), image_file))
+
+    def pending(self):
+        '''按领取的顺序返回所有 pending 任务的路径。'''
+        return [path for path, in self.conn.execute("SELECT path FROM jobs WHERE state = 'pending' ORDER BY path")]
 
-            response = model.generate_content([query, img.convert('RGB')], stream=False)
+    def attempts(self, image_file):
+        return self.conn.execute('SELECT attempts FROM jobs WHERE path = ?', (image_file,)).fetchone()[0]
 
-            output_filename = os.path.splitext(os.path.basename(image_file))[0] + cap_extension
-            output_file_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    def counts(self):
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
 
-            with open(output_file_path, 'w', encoding='utf-8') as file:
-                file.write(response.text)
+    def close(self):
+        self.conn.close()
 
-            print(f"Caption saved to {output_file_path}")
+
+def caption_image(model, image_file, output_folder, cache_dir, cache=None):
+    '''打标一张图片并写入 txt，返回 (原始字节数, 上传字节数)；使用缓存的结果时都是 0。'''
+    original_size = prepared_size = 0
+    image_hash = caption_cache.file_sha256(image_file) if cache is not None else None
+    text = cache.get(image_hash, MODEL_NAME, query) if cache is not None else None
+    if text is None:
+        payload_path, original_size, prepared_size = upload_prep.prepare_image(image_file, cache_dir)
+        with open(payload_path, 'rb') as payload:
+            img = {'mime_type': upload_prep.MIME_TYPES[upload_prep.IMAGE_FORMAT], 'data': payload.read()}
+
+        response = model.generate_content([query, img], stream=False)
+        try:
+            text = response.text
+        except ValueError:
+            # 被安全设置拦截时没有 text，把拦截原因作为错误信息
+            raise ValueError(f"no text in response: {response.prompt_feedback}")
+        if cache is not None:
+            cache.put(image_hash, MODEL_NAME, query, text)
+
+    output_filename = os.path.splitext(os.path.basename(image_file))[0] + cap_extension
+    output_file_path = os.path.join(output_folder, output_filename)
+    with open(output_file_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return original_size, prepared_size
+
+
+def run_worker(ledger_path, output_folder, cache_dir, max_attempts=MAX_ATTEMPTS, move_failed=False,
+               cache_path=caption_cache.DEFAULT_CACHE_PATH):
+    '''工作进程：不断领取任务直到没有 pending 任务，返回 {'done', 'cached', 'failed', 'original_bytes', 'prepared_bytes'}。'''
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    ledger = JobLedger(ledger_path)
+    cache = caption_cache.CaptionCache(cache_path) if cache_path else None
+    model = make_model()
+    stats = {'done': 0, 'cached': 0, 'failed': 0, 'original_bytes': 0, 'prepared_bytes': 0}
+    error_list_path = os.path.join(output_folder, "error_list.txt")
+    while (image_file := ledger.claim(worker)) is not None:
+        try:
+            original_size, prepared_size = caption_image(model, image_file, output_folder, cache_dir, cache)
         except Exception as e:
-            print(f"Error processing {image_file}: {e}: {response.prompt_feedback}")
-            with open(OUTPUT_FOLDER + "\error_list.txt", 'a+', encoding='utf-8') as file:
+            print(f"Error processing {image_file}: {e}")
+            ledger.finish(image_file, str(e))
+            stats['failed'] += 1
+            with open(error_list_path, 'a+', encoding='utf-8') as file:
                 file.write(image_file + "\n")
-            # move to error folder
-            os.rename(image_file, os.path.join(os.path.dirname(image_file), "error", os.path.basename(image_file)))
+            # 用完所有尝试次数后才移动到 error 文件夹，否则之后无法重试
+            if move_failed and ledger.attempts(image_file) >= max_attempts:
+                error_folder = os.path.join(os.path.dirname(image_file), "error")
+                os.makedirs(error_folder, exist_ok=True)
+                shutil.move(image_file, os.path.join(error_folder, os.path.basename(image_file)))
+            continue
+        ledger.finish(image_file)
+        stats['done'] += 1
+        stats['cached'] += not original_size
+        stats['original_bytes'] += original_size
+        stats['prepared_bytes'] += prepared_size
+    ledger.close()
+    if cache is not None:
+        cache.close()
+    return stats
+
+
+def main(image_folder, output_folder, workers=WORKERS, max_attempts=MAX_ATTEMPTS, retry_error_contains=None,
+         move_failed=False, cache_path=caption_cache.DEFAULT_CACHE_PATH, prepare_workers=PREPARE_WORKERS):
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    ledger_path = os.path.join(output_folder, "_caption_jobs.sqlite")
+    cache_dir = os.path.join(image_folder, upload_prep.CACHE_FOLDER)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    image_files = sorted(os.path.join(image_folder, f) for f in os.listdir(image_folder) if
+                         os.path.splitext(f)[1].lower() in image_extensions)
+    ledger = JobLedger(ledger_path)
+    ledger.add(image_files, output_folder)
+    stale = ledger.reset_stale()
+    retried = ledger.retry_failed(max_attempts, retry_error_contains)
+    counts = ledger.counts()
+    print(f"共 {len(image_files)} 张图片：待处理 {counts.get('pending', 0)} 张（其中重试 {retried} 张、"
+          f"恢复中断的 {stale} 张），已完成 {counts.get('done', 0)} 张。")
+
+    totals = {'done': 0, 'cached': 0, 'failed': 0, 'original_bytes': 0, 'prepared_bytes': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_worker, ledger_path, output_folder, cache_dir, max_attempts, move_failed,
+                                   cache_path)
+                   for _ in range(workers)]
+        # 工作进程等待 API 时，在另一个进程池中按领取的顺序提前预处理图片；
+        # 工作进程调用 prepare_image 时直接命中磁盘缓存，解码、缩放和编码与网络请求重叠
+        for _ in tqdm(upload_prep.iter_prepared(ledger.pending(), cache_dir, max_workers=prepare_workers),
+                      desc="Preparing"):
+            if all(future.done() for future in futures):
+                break
+        for future in tqdm(futures, desc="Workers"):
+            for key, value in future.result().items():
+                totals[key] += value
+
+    counts = ledger.counts()
+    ledger.close()
+    upload_prep.report({'images': totals['done'] - totals['cached'], 'original_bytes': totals['original_bytes'],
+                        'prepared_bytes': totals['prepared_bytes']})
+    print(f"本次成功 {totals['done']} 张（其中使用缓存 {totals['cached']} 张），失败 {totals['failed']} 张，耗时 {time.time() - start_time:.2f} 秒。"
+          f"任务表：{counts}")
+
 
+if __name__ == "__main__":
+    main(IMAGE_FOLDER, OUTPUT_FOLDER)
+    # 只重试错误信息包含 429 的图片：
+    # main(IMAGE_FOLDER, OUTPUT_FOLDER, retry_error_contains='429')
@@ -2,23 +2,73 @@
 使用ZhipuAI的API来对图像进行打标，并将打标结果保存到文本文件中。
 需要安装依赖库: pip install zhipuai
 需要申请ZhipuAI的APIKey，申请地址：https://open.bigmodel.cn/
+多张图片并发打标：线程池限制同时进行的请求数，令牌桶限制每秒的请求数，遇到 429 和 5xx 按指数退避重试。
+上传前用 upload_prep 在进程池中把图片缩小并重新编码，结果缓存在 _upload_cache 中，重试不会重复处理。
+已经有同名 txt 文件的图片会跳过；内容相同的图片用同样的模型和提示词打过标时直接使用 caption_cache 中的结果。benchmark_concurrency 用本地模拟服务器（可设置延迟和 429 比例）测试不同并发数的吞吐量。
 '''
 import os
+import json
+import time
+import random
 import base64
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import zhipuai
 from zhipuai import ZhipuAI
+import upload_prep
+import caption_cache
 
 # 密钥
 api_key = "your api key"  # 填写自己的APIKey
-client = ZhipuAI(api_key=api_key)
 
 # 打标文件路径
 output_folder_path = 'your dataset folder'  # 注意复制的路径中的\要改为/
 
+# 同时进行的请求数和每秒最多发出的请求数
+CONCURRENCY = 8
+REQUESTS_PER_SECOND = 4.0
+# 每张图片最多尝试的次数，以及第一次重试前等待的秒数（之后每次翻倍）
+MAX_ATTEMPTS = 6
+BACKOFF_SECONDS = 1.0
+MODEL = "glm-4v"  # 填写需要调用的模型名称
+PROMPT = "请用英文详细描述这张图像。不要使用任何中文，不要分段落。"
+
+
+def make_client(api_key, base_url=None):
+    # 重试由 caption_image 统一处理，关闭 SDK 自带的重试
+    return ZhipuAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+
+class TokenBucket:
+    '''线程安全的令牌桶：每秒补充 rate 个令牌，最多存 capacity 个，acquire 在没有令牌时等待。'''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
 
 # 获取所有图片文件路径
 def get_all_image_paths(directory):
     image_paths = []
     for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != upload_prep.CACHE_FOLDER]
         for file in files:
             if file.lower().endswith(('.png', '.jpg', '.jpeg')):
                 image_paths.append(os.path.join(root, file))
@@ -39,41 +89,212 @@ def save_to_txt(file_name, content):
     print(f"文件 {txt_file_path} 已保存。")
 
 
-# 打标并保存结果
-def start_tags(file_dir):
-    image_paths = get_all_image_paths(file_dir)
-    for image_path in image_paths:
-        # 检查对应的txt文件是否已存在，如果存在则跳过打标
-        txt_file_path = os.path.splitext(image_path)[0] + '.txt'
-        if os.path.exists(txt_file_path):
-            print(f"文件 {txt_file_path} 已存在，跳过打标。")
-            continue
-
-        print(image_path, '开始打标')
-        image_base64 = image_to_base64(image_path)
-        response = client.chat.completions.create(
-            model="glm-4v",  # 填写需要调用的模型名称
-            messages=[
-                {"role": "user",
-                 "content": [
-                     {
-                         "type": "text",
-                         "text": "请用英文详细描述这张图像。不要使用任何中文，不要分段落。"
-                     },
-                     {
-                         "type": "image_url",
-                         "image_url": {
-                             "url": image_base64
+def is_retryable(error):
+    '''429、5xx、超时和连接错误可以重试，其他错误（参数、鉴权等）直接失败。'''
+    if isinstance(error, zhipuai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (zhipuai.APITimeoutError, zhipuai.APIConnectionError))
+
+
+def caption_image(client, payload_path, bucket, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS):
+    '''上传 payload_path（预处理后的图片）打标，返回 (打标结果, 尝试次数)；遇到可重试的错误按指数退避重试。'''
+    image_base64 = image_to_base64(payload_path)
+    for attempt in range(1, max_attempts + 1):
+        bucket.acquire()
+        try:
+            response = client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "user",
+                     "content": [
+                         {
+                             "type": "text",
+                             "text": PROMPT
+                         },
+                         {
+                             "type": "image_url",
+                             "image_url": {
+                                 "url": image_base64
+                             }
                          }
-                     }
-                 ]
-                 },
-            ],
-        )
+                     ]
+                     },
+                ],
+            )
+            return response.choices[0].message.content, attempt
+        except Exception as e:
+            if attempt == max_attempts or not is_retryable(e):
+                raise
+            # 服务器给了 Retry-After 就按它等待，否则指数退避并加上随机抖动
+            retry_after = None
+            if isinstance(e, zhipuai.APIStatusError):
+                retry_after = e.response.headers.get('retry-after')
+            delay = float(retry_after) if retry_after else backoff * 2 ** (attempt - 1) * (0.5 + random.random())
+            time.sleep(delay)
+
+
+def caption_images(client, items, on_result, concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND,
+                   max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS, on_failure=None):
+    '''
+    用线程池并发打标 (image_path, payload_path)，同时等待的任务数有上限。每张图片完成后调用 on_result(image_path, content)，
+    失败（包括预处理失败）时调用 on_failure(image_path, error)。
+    返回 {'done': 成功数, 'failed': [(image_path, error)], 'retries': 重试次数}。
+    '''
+    bucket = TokenBucket(rate)
+    stats = {'done': 0, 'failed': [], 'retries': 0}
+
+    def fail(image_path, error):
+        stats['failed'].append((image_path, error))
+        if on_failure is not None:
+            on_failure(image_path, error)
+
+    def collect(futures):
+        for future in futures:
+            image_path = pending.pop(future)
+            try:
+                content, attempts = future.result()
+            except Exception as e:
+                print(f"{image_path} 打标失败: {e}")
+                fail(image_path, str(e))
+                continue
+            stats['retries'] += attempts - 1
+            stats['done'] += 1
+            on_result(image_path, content)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for image_path, payload_path in items:
+            if payload_path is None:
+                fail(image_path, '预处理失败')
+                continue
+            if len(pending) >= concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(caption_image, client, payload_path, bucket, max_attempts, backoff)
+            pending[future] = image_path
+        collect(list(pending))
+    return stats
+
+
+# 打标并保存结果
+def start_tags(file_dir, client, concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND, cache_path=caption_cache.DEFAULT_CACHE_PATH):
+    start_time = time.time()
+    cache = caption_cache.CaptionCache(cache_path) if cache_path else None
+    # 已提交的图片的内容哈希，以及等待同一内容打标结果的其他副本
+    submitted = {}
+    followers = defaultdict(list)
+    cached_count = 0
+
+    def pending_images():
+        nonlocal cached_count
+        for image_path in get_all_image_paths(file_dir):
+            # 检查对应的txt文件是否已存在，如果存在则跳过打标
+            txt_file_path = os.path.splitext(image_path)[0] + '.txt'
+            if os.path.exists(txt_file_path):
+                print(f"文件 {txt_file_path} 已存在，跳过打标。")
+                continue
+            if cache is not None:
+                image_hash = caption_cache.file_sha256(image_path)
+                content = cache.get(image_hash, MODEL, PROMPT)
+                if content is not None:
+                    print(image_path, '使用缓存的打标结果')
+                    save_to_txt(image_path, content)
+                    cached_count += 1
+                    continue
+                if image_hash in followers:
+                    # 内容相同的图片正在打标，等它的结果
+                    followers[image_hash].append(image_path)
+                    continue
+                followers[image_hash] = []
+                submitted[image_path] = image_hash
+            yield image_path
+
+    def on_result(image_path, content):
         print(image_path, '打标结束')
-        content = response.choices[0].message.content
         print(content)
         save_to_txt(image_path, content)
+        if cache is not None:
+            image_hash = submitted.pop(image_path)
+            cache.put(image_hash, MODEL, PROMPT, content)
+            for follower in followers.pop(image_hash):
+                save_to_txt(follower, content)
+
+    failed_followers = []
+
+    def on_failure(image_path, error):
+        # 第一份副本失败时，等它结果的其他副本也记为失败，下次运行会重新打标
+        if cache is not None and image_path in submitted:
+            for follower in followers.pop(submitted.pop(image_path)):
+                print(f"{follower} 打标失败: 与 {image_path} 内容相同，{image_path} 打标失败")
+                failed_followers.append((follower, f"与 {image_path} 内容相同: {error}"))
+
+    # 预处理在进程池中提前进行，与网络请求重叠
+    upload_stats = {}
+    prepared = upload_prep.iter_prepared(pending_images(), os.path.join(file_dir, upload_prep.CACHE_FOLDER), upload_stats)
+    stats = caption_images(client, prepared, on_result, concurrency, rate, on_failure=on_failure)
+    stats['failed'].extend(failed_followers)
+    upload_prep.report(upload_stats)
+    if cache is not None:
+        cache.close()
+    elapsed_time = time.time() - start_time
+    print(f"打标完成。成功 {stats['done']} 张，使用缓存 {cached_count} 张，失败 {len(stats['failed'])} 张，"
+          f"重试 {stats['retries']} 次，耗时 {elapsed_time:.2f} 秒。")
+    return stats
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''模拟智谱的 chat/completions 接口：等待 latency 秒后返回固定结果，按 rate_limit_ratio 的概率返回 429。'''
+    latency = 0.5
+    rate_limit_ratio = 0.1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if random.random() < self.rate_limit_ratio:
+            body = json.dumps({'error': {'code': '1302', 'message': 'rate limited'}}).encode('utf-8')
+            self.send_response(429)
+            self.send_header('Retry-After', '0.2')
+        else:
+            body = json.dumps({
+                'id': 'stub', 'created': int(time.time()), 'model': 'glm-4v',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': 'A stub caption.'}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            }).encode('utf-8')
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency=0.5, rate_limit_ratio=0.1):
+    '''在后台线程中启动模拟服务器，返回 (server, base_url)，用完调用 server.shutdown()。'''
+    handler = type('Handler', (StubHandler,), {'latency': latency, 'rate_limit_ratio': rate_limit_ratio})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def benchmark_concurrency(file_dir, levels=(1, 2, 4, 8, 16), n_images=64, latency=0.5, rate_limit_ratio=0.1,
+                          rate=1000.0):
+    '''对模拟服务器用不同的并发数打标同一批图片（不写 txt），打印吞吐量和重试次数。'''
+    image_paths = get_all_image_paths(file_dir)[:n_images]
+    server, base_url = start_stub_server(latency, rate_limit_ratio)
+    try:
+        client = make_client('stub.secret', base_url)
+        for concurrency in levels:
+            start_time = time.time()
+            stats = caption_images(client, [(image_path, image_path) for image_path in image_paths], lambda image_path, content: None, concurrency, rate,
+                                   backoff=0.1)
+            elapsed_time = time.time() - start_time
+            print(f"并发 {concurrency:>3}: {len(image_paths)} 张图片耗时 {elapsed_time:.2f} 秒，"
+                  f"{stats['done'] / elapsed_time:.2f} 张/秒，重试 {stats['retries']} 次，失败 {len(stats['failed'])} 张")
+    finally:
+        server.shutdown()
 
 
 if __name__ == "__main__":
@@ -81,4 +302,6 @@ if __name__ == "__main__":
     if not os.path.exists(output_folder_path):
         os.makedirs(output_folder_path)
     
-    start_tags(output_folder_path)
+    start_tags(output_folder_path, make_client(api_key))
+    # 用本地模拟服务器测试不同并发数的吞吐量：
+    # benchmark_concurrency(output_folder_path)
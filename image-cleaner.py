@@ -1,20 +1,70 @@
 """
 This script is used to clean up the image tags in the dataset.
 It removes the unnecessary prefix of the image tags.
+All prefix rules are compiled into one case-insensitive regex and can be loaded from a JSON config
+(see DEFAULT_RULES). The glm4-cleaner.py rules, cutting everything from "Overall," and collapsing
+newlines, are optional rules applied in the same read/write pass. Files are processed in a process
+pool and only written back when their content actually changed.
 """
 import os
 import re
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+CHINESE_PATTERN = re.compile('[\u4e00-\u9fa5]')
+DEFAULT_RULES = {
+    'prefixes': ['The image shows', 'The photo shows', 'The picture shows',
+                 'The image showcases', 'The image depicts', 'The image features',
+                 'The image captures', 'The image displays',
+                 'This image shows', 'This photo shows', 'This picture shows',
+                 'This image showcases', 'This image depicts', 'This image features',
+                 'This image captures', 'This image displays'],
+    # Cut the caption at this marker, None to keep everything (glm4-cleaner.py uses "Overall,")
+    'truncate_at': None,
+    # Replace newlines and the whitespace around them with a single space
+    'collapse_newlines': False,
+}
 
 
 def contains_chinese(text):
-    chinese_pattern = re.compile('[\u4e00-\u9fa5]')
-    return bool(chinese_pattern.search(text))
+    return bool(CHINESE_PATTERN.search(text))
 
 
 def is_empty_file(file_path):
     return os.path.exists(file_path) and os.path.getsize(file_path) == 0
 
 
+def load_rules(config_path=None):
+    """Load the rules from a JSON file, missing keys fall back to DEFAULT_RULES."""
+    rules = dict(DEFAULT_RULES)
+    if config_path:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            rules.update(json.load(f))
+    return rules
+
+
+class CaptionNormalizer:
+    def __init__(self, rules):
+        # Longest prefixes first so "The image shows" never wins over a longer rule sharing its start
+        prefixes = sorted(rules['prefixes'], key=len, reverse=True)
+        self.prefix_pattern = re.compile(r'(?:%s)\b\s*' % '|'.join(re.escape(p) for p in prefixes),
+                                         re.IGNORECASE) if prefixes else None
+        self.truncate_at = rules.get('truncate_at')
+        self.newline_pattern = re.compile(r'\s*\n\s*') if rules.get('collapse_newlines') else None
+
+    def normalize(self, content):
+        if self.truncate_at:
+            content = content.split(self.truncate_at, 1)[0]
+        if self.newline_pattern is not None:
+            content = self.newline_pattern.sub(' ', content)
+        content = content.lstrip()
+        # Strip repeatedly, like the old loop did for prefixes stacked in list order
+        while self.prefix_pattern is not None and (match := self.prefix_pattern.match(content)):
+            content = content[match.end():]
+        return content
+
+
 # def move_to_error_folder(file_path):
 #     os.rename(file_path, os.path.join(os.path.dirname(file_path),
 #                                       "error", os.path.basename(file_path)))
@@ -25,48 +75,65 @@ def move_to_error_folder(file_path):
     os.rename(file_path, os.path.join(error_folder_path, os.path.basename(file_path)))
 
 
-def process_txt_file(file_path):
+_normalizer = None
+
+
+def init_worker(rules):
+    """Compile the rules once per worker process."""
+    global _normalizer
+    _normalizer = CaptionNormalizer(rules)
+
+
+def process_txt_file(file_path, normalizer=None):
+    """Clean one caption file and return what happened to it."""
+    normalizer = normalizer or _normalizer
     if is_empty_file(file_path):
         print(f'The file {file_path} is empty.')
         move_to_error_folder(file_path)
-    else:
-        content = ''
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                content = file.read()
-        except UnicodeDecodeError as e:
-            print(f"file_path: {file_path} UnicodeDecodeError: {e}")
-            move_to_error_folder(file_path)
+        return 'empty'
 
-        content = content.lstrip()
+    try:
+        with open(file_path, 'r', encoding='utf-8', newline='') as file:
+            original = file.read()
+    except UnicodeDecodeError as e:
+        print(f"file_path: {file_path} UnicodeDecodeError: {e}")
+        move_to_error_folder(file_path)
+        return 'decode_error'
+
+    if contains_chinese(original):
+        print(f"File contains Chinese characters and will not be processed: {file_path}")
+        move_to_error_folder(file_path)
+        return 'chinese'
 
-        if contains_chinese(content):
-            print(f"File contains Chinese characters and will not be processed: {file_path}")
-            move_to_error_folder(file_path)
-        else:
-            prefixes = ['The image shows', 'The photo shows', 'The picture shows',
-                        'The image showcases', 'The image depicts', 'The image features',
-                        'The image captures', 'The image displays',
-                        'This image shows', 'This photo shows', 'This picture shows',
-                        'This image showcases', 'This image depicts', 'This image features',
-                        'this image captures', 'this image displays']
-            for prefix in prefixes:
-                if content.startswith(prefix):
-                    content = content[len(prefix):].lstrip()
-
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write(content)
-        print(f"Processed file: {file_path}")
-
-
-def process_folder(folder_path):
+    content = normalizer.normalize(original)
+    if content == original:
+        return 'unchanged'
+    with open(file_path, 'w', encoding='utf-8', newline='') as file:
+        file.write(content)
+    return 'changed'
+
+
+def iter_txt_files(folder_path):
     for root, dirs, files in os.walk(folder_path):
+        # Files moved to error folders have already been handled
+        dirs[:] = [d for d in dirs if d != "error"]
         for file in files:
             if file.endswith('.txt'):
-                file_path = os.path.join(root, file)
-                process_txt_file(file_path)
+                yield os.path.join(root, file)
+
+
+def process_folder(folder_path, config_path=None, max_workers=None):
+    rules = load_rules(config_path)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(rules,)) as executor:
+        results = Counter(executor.map(process_txt_file, iter_txt_files(folder_path), chunksize=256))
+    print(f"Processed {sum(results.values())} files: {results.get('changed', 0)} changed, "
+          f"{results.get('unchanged', 0)} unchanged, {results.get('empty', 0)} empty, "
+          f"{results.get('decode_error', 0)} undecodable, {results.get('chinese', 0)} with Chinese.")
+    return results
 
 
 if __name__ == "__main__":
     folder_path = "your input folder"
-    process_folder(folder_path)
+    # Optional JSON file overriding DEFAULT_RULES, e.g. {"truncate_at": "Overall,", "collapse_newlines": true}
+    config_path = None
+    process_folder(folder_path, config_path)
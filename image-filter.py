@@ -1,52 +1,231 @@
-﻿import os
+﻿'''
+按尺寸和是否有人物把图片复制到两个文件夹。
+流水线分成几步同时进行：先只读文件头检查尺寸，太小的直接复制，不解码；
+其余图片由解码线程池解码并缩小到检测尺寸，凑成批次交给检测器批量推理；复制由单独的线程池异步完成。
+检测器可以替换：任何接受 PIL 图片列表、返回同样长度的 bool 列表的可调用对象都可以，默认是 YOLOv8n 人物检测，
+benchmark_filter 用 StubDetector 在没有 ultralytics 的环境中测试流水线。结束时打印每一步的耗时。
+'''
+import os
+import time
 import shutil
-from PIL import Image
-from ultralytics import YOLO
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageStat
 
-def copy_images_based_on_conditions(source_directory, target_directory, non_target_directory, min_size=(768, 768)):
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+# 检测器的输入尺寸，解码时直接缩小到这个尺寸
+DETECT_SIZE = 640
+BATCH_SIZE = 16
+DECODE_WORKERS = os.cpu_count()
+COPY_WORKERS = 4
+# 最多提前解码多少张图片
+LOOKAHEAD = BATCH_SIZE * 4
+# 最多同时排队等待复制的图片数，复制比检测慢时检测会等待复制
+MAX_PENDING_COPIES = COPY_WORKERS * 8
+
+
+class YoloPersonDetector:
+    '''用 YOLOv8 批量检测图片中是否有人物。'''
+
+    def __init__(self, model_path='yolov8n.pt', image_size=DETECT_SIZE, confidence=0.25):
+        from ultralytics import YOLO
+        # 加载预训练的YOLOv8n模型
+        self.model = YOLO(model_path)  # 使用轻量版的YOLOv8n模型
+        self.image_size = image_size
+        self.confidence = confidence
+
+    def __call__(self, images):
+        results = self.model(images, imgsz=self.image_size, conf=self.confidence, classes=[0], verbose=False)
+        # '0' 类别是 'person'
+        return [any(int(cls) == 0 for cls in result.boxes.cls) for result in results]
+
+
+class StubDetector:
+    '''测试用的检测器：平均亮度超过 threshold 的图片算作有人物。'''
+
+    def __init__(self, threshold=128, seconds_per_image=0.0):
+        self.threshold = threshold
+        self.seconds_per_image = seconds_per_image
+
+    def __call__(self, images):
+        time.sleep(self.seconds_per_image * len(images))
+        return [sum(ImageStat.Stat(img.convert('L')).mean) > self.threshold for img in images]
+
+
+class StageTimer:
+    '''累计每一步的耗时，多个线程可以同时调用 add。'''
+
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+
+    def report(self, total_seconds, image_count):
+        print(f"共 {image_count} 张图片，总耗时 {total_seconds:.2f} 秒（{image_count / max(total_seconds, 1e-9):.1f} 张/秒）。")
+        for stage, seconds in self.seconds.items():
+            print(f"    {stage}: {seconds:.2f} 秒")
+
+
+def list_images(source_directory):
+    for root, dirs, files in os.walk(source_directory):
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, file)
+
+
+def load_image(file_path, min_size, detect_size, timer):
+    '''
+    返回 (file_path, 原始尺寸, 缩小后的图片或 None)。Image.open 只读取文件头，尺寸太小时不解码像素。
+    '''
+    start_time = time.perf_counter()
+    with Image.open(file_path) as img:
+        size = img.size
+        if size[0] < min_size[0] or size[1] < min_size[1]:
+            timer.add('检查尺寸', time.perf_counter() - start_time)
+            return file_path, size, None
+        # JPEG 直接按缩小的尺寸解码
+        img.draft('RGB', (detect_size, detect_size))
+        small = img.convert('RGB')
+    small.thumbnail((detect_size, detect_size), Image.BILINEAR)
+    timer.add('解码和缩小', time.perf_counter() - start_time)
+    return file_path, size, small
+
+
+def copy_image(file_path, directory, reason, timer, verbose=True):
+    start_time = time.perf_counter()
+    shutil.copy2(file_path, os.path.join(directory, os.path.basename(file_path)))
+    timer.add('复制', time.perf_counter() - start_time)
+    if verbose:
+        print(f"Copying {file_path} to {directory} ({reason})")
+
+
+def copy_images_based_on_conditions(source_directory, target_directory, non_target_directory, min_size=(768, 768),
+                                    detector=None, batch_size=BATCH_SIZE, decode_workers=DECODE_WORKERS,
+                                    copy_workers=COPY_WORKERS, detect_size=DETECT_SIZE, lookahead=LOOKAHEAD,
+                                    max_pending_copies=MAX_PENDING_COPIES, verbose=True):
+    '''detector 为 None 时使用 YoloPersonDetector，返回 {'person', 'no_person', 'too_small', 'errors', 'copy_errors'} 计数。'''
+    start_time = time.perf_counter()
     if not os.path.exists(target_directory):
         os.makedirs(target_directory)
     if not os.path.exists(non_target_directory):
         os.makedirs(non_target_directory)
+    if detector is None:
+        detector = YoloPersonDetector(image_size=detect_size)
 
-    # 加载预训练的YOLOv8n模型
-    model = YOLO('yolov8n.pt')  # 使用轻量版的YOLOv8n模型
+    timer = StageTimer()
+    counts = {'person': 0, 'no_person': 0, 'too_small': 0, 'errors': 0, 'copy_errors': 0}
+    image_paths = list_images(source_directory)
+    with ThreadPoolExecutor(max_workers=decode_workers) as decoder, \
+            ThreadPoolExecutor(max_workers=copy_workers) as copier:
+        pending = deque()
+        batch = []
+        copies = {}
 
-    for root, dirs, files in os.walk(source_directory):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                file_path = os.path.join(root, file)
+        def collect_copies(futures):
+            for future in futures:
+                file_path = copies.pop(future)
                 try:
-                    with Image.open(file_path) as img:
-                        # 检查图片尺寸
-                        if img.size[0] >= min_size[0] and img.size[1] >= min_size[1]:
-                            # 检测图片中是否有人物
-                            results = model(img)
-                            has_person = False
-                            for result in results:
-                                for bbox in result.boxes:
-                                    if int(bbox.cls) == 0:  # '0' 类别是 'person'
-                                        has_person = True
-                                        break
-                                if has_person:
-                                    break
-
-                            if has_person:
-                                print(f"Copying {file_path} to {target_directory} (size: {img.size}, person detected)")
-                                shutil.copy2(file_path, os.path.join(target_directory, file))
-                            else:
-                                print(f"Copying {file_path} to {non_target_directory} (size: {img.size}, no person detected)")
-                                shutil.copy2(file_path, os.path.join(non_target_directory, file))
-                        else:
-                            print(f"Copying {file_path} to {non_target_directory} (size: {img.size}, too small)")
-                            shutil.copy2(file_path, os.path.join(non_target_directory, file))
-
+                    future.result()
                 except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
-    print("Finished filtering images.")
-    
+                    print(f"Error copying {file_path}: {e}")
+                    counts['copy_errors'] += 1
+
+        def submit_copy(file_path, directory, reason):
+            # 和解码一样限制同时等待的复制任务数，内存不随图片数量增长
+            if len(copies) >= max_pending_copies:
+                done, _ = wait(copies, return_when=FIRST_COMPLETED)
+                collect_copies(done)
+            copies[copier.submit(copy_image, file_path, directory, reason, timer, verbose)] = file_path
+
+        def submit_next():
+            for file_path in image_paths:
+                pending.append((file_path, decoder.submit(load_image, file_path, min_size, detect_size, timer)))
+                return
+
+        def detect(items):
+            '''批量检测，整批失败时逐张重试，单张失败的记为错误，返回 [(file_path, size, 是否有人物)]。'''
+            try:
+                has_person = detector([small for _, _, small in items])
+                if len(has_person) != len(items):
+                    raise ValueError(f"检测器返回了 {len(has_person)} 个结果，应为 {len(items)} 个")
+                return [(file_path, size, person) for (file_path, size, _), person in zip(items, has_person)]
+            except Exception as e:
+                if len(items) == 1:
+                    print(f"Error processing {items[0][0]}: {e}")
+                    counts['errors'] += 1
+                    return []
+                print(f"批量检测失败，逐张重试: {e}")
+                return [result for item in items for result in detect([item])]
+
+        def run_batch():
+            inference_start = time.perf_counter()
+            results = detect(batch)
+            timer.add('批量推理', time.perf_counter() - inference_start)
+            for file_path, size, person in results:
+                if person:
+                    counts['person'] += 1
+                    submit_copy(file_path, target_directory, f"size: {size}, person detected")
+                else:
+                    counts['no_person'] += 1
+                    submit_copy(file_path, non_target_directory, f"size: {size}, no person detected")
+            batch.clear()
+
+        for _ in range(lookahead):
+            submit_next()
+        while pending:
+            file_path, future = pending.popleft()
+            submit_next()
+            try:
+                file_path, size, small = future.result()
+            except Exception as e:
+                print(f"Error processing {file_path}: {e}")
+                counts['errors'] += 1
+                continue
+            if small is None:
+                counts['too_small'] += 1
+                submit_copy(file_path, non_target_directory, f"size: {size}, too small")
+                continue
+            batch.append((file_path, size, small))
+            if len(batch) >= batch_size:
+                run_batch()
+        if batch:
+            run_batch()
+
+        collect_copies(list(copies))
+
+    total = counts['person'] + counts['no_person'] + counts['too_small'] + counts['errors']
+    timer.report(time.perf_counter() - start_time, total)
+    print(f"Finished filtering images. {counts}")
+    return counts
+
+
+def benchmark_filter(n=400, decode_workers_list=(1, 2, 4, 8), size=(1600, 1200), seconds_per_image=0.005):
+    '''在临时文件夹中生成 n 张图片，用 StubDetector 比较不同解码线程数的吞吐量。'''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_directory = os.path.join(temp_dir, 'source')
+        os.makedirs(source_directory)
+        for i in range(n):
+            # 一半图片太小，一半需要解码和检测
+            image_size = size if i % 2 else (size[0] // 4, size[1] // 4)
+            Image.effect_noise(image_size, 64 + i % 128).convert('RGB').save(
+                os.path.join(source_directory, f'{i:05d}.jpg'), quality=90)
+        for decode_workers in decode_workers_list:
+            target_directory = os.path.join(temp_dir, f'target_{decode_workers}')
+            non_target_directory = os.path.join(temp_dir, f'non_target_{decode_workers}')
+            print(f"解码线程数 {decode_workers}:")
+            copy_images_based_on_conditions(source_directory, target_directory, non_target_directory,
+                                            detector=StubDetector(seconds_per_image=seconds_per_image),
+                                            decode_workers=decode_workers, verbose=False)
+
+
 if __name__ == "__main__":
     source_directory = "D:\\AI\\Materials\\X"
     target_directory = "D:\\AI\\Materials\\GoodImages"
     non_target_directory = "D:\\AI\\Materials\\BadImages"
     copy_images_based_on_conditions(source_directory, target_directory, non_target_directory)
+    # benchmark_filter()
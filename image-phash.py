@@ -1,9 +1,24 @@
 '''
 利用感知哈希值（Perceptual Hash，pHash）给图片计算哈希值，找出重复的图片。
+支持按汉明距离阈值查找近似重复的图片（重新编码、轻微裁剪、加水印等），
+使用多索引哈希表（Multi-Index Hashing）查找近邻，避免两两比较；每个重复簇保留像素最多的一张，像素相同时保留文件最大的。
+哈希值保存在 SQLite 索引中（以路径、文件大小和修改时间为键），重新运行时只计算新增或修改过的图片，
+并与索引中已有的图片去重；query_folder 可以用已有的索引检查新文件夹，而不用重新扫描参考图片。
+计算哈希值之前先按文件大小、首尾采样摘要和完整摘要找出字节完全相同的文件（包括与索引中已有文件相同的新文件），这些文件不需要解码；
+完整摘要只在文件大小相同时才计算，并保存在索引中。
+每张图片只解码一次（JPEG 直接按缩小的尺寸解码），从同一张缩略图批量计算 pHash、dHash、aHash 和颜色哈希，
+去重时可以再用 dHash 确认 pHash 找到的图片对。
 '''
 import os
 import shutil
-import imagehash
+import random
+import sqlite3
+import itertools
+import hashlib
+import numpy as np
+from collections import defaultdict
+from itertools import combinations
+from math import comb
 from PIL import Image
 from tqdm import tqdm
 import concurrent.futures
@@ -11,19 +26,464 @@ import logging
 import time
 
 
-def calculate_hash(image_path, corrupt_folder, target_size=(256, 256)):
-    try:
-        with Image.open(image_path) as img:
-            img = img.resize(target_size)
-            hash_val = imagehash.phash(img)
-        return image_path, hash_val, os.path.getsize(image_path), None
-    except Exception as e:
-        logging.error(f"无法处理图片 {image_path}: {e}")
-        shutil.move(image_path, os.path.join(corrupt_folder, os.path.basename(image_path)))
-        return image_path, None, 0, e
+def load_thumbnail(image_path, side):
+    '''
+    解码为 side x side 的 RGB 缩略图，JPEG 用 draft 直接按 1/2、1/4 或 1/8 的尺寸解码。
+    返回 (缩略图, 原图尺寸)，尺寸在 draft 之前从文件头读取。
+    '''
+    with Image.open(image_path) as img:
+        original_size = img.size
+        img.draft('RGB', (side * DRAFT_FACTOR, side * DRAFT_FACTOR))
+        img = img.convert('RGB').resize((side, side), Image.LANCZOS, reducing_gap=2.0)
+    return np.asarray(img, dtype=np.float64), original_size
 
 
-def find_duplicates(directory, hash_size=8):
+def dct_matrix(n):
+    '''与 scipy.fftpack.dct(type=2) 相同（未归一化）的 DCT-II 矩阵。'''
+    k = np.arange(n)[:, None]
+    return 2 * np.cos(np.pi * k * (2 * np.arange(n)[None, :] + 1) / (2 * n))
+
+
+def area_matrix(n_out, n_in):
+    '''把长度 n_in 的一维信号按面积平均缩到 n_out 的矩阵。'''
+    edges = np.linspace(0, n_in, n_out + 1)
+    pixels = np.arange(n_in)
+    overlap = np.clip(np.minimum(edges[1:, None], pixels[None, :] + 1) - np.maximum(edges[:-1, None], pixels[None, :]), 0, None)
+    return overlap / overlap.sum(axis=1, keepdims=True)
+
+
+def bits_to_hex(bits):
+    '''把 (N, n_bits) 的布尔数组转成与 imagehash 相同格式的十六进制字符串。'''
+    n_bits = bits.shape[1]
+    padded = np.zeros((bits.shape[0], -n_bits % 8 + n_bits), dtype=bool)
+    padded[:, -n_bits:] = bits
+    width = (n_bits + 3) // 4
+    return [row.tobytes().hex()[-width:] for row in np.packbits(padded, axis=1)]
+
+
+def color_hash_bits(rgb):
+    '''
+    仿照 imagehash.colorhash（binbits=3）计算颜色哈希：黑色、灰色以及 6 个色相区间的淡色和艳色比例。
+    这只是近似：统计的是缩小后的缩略图而不是原图，HSV 的换算和取整也与 PIL 不同，
+    纯色图片的结果与 imagehash 相同，一般图片则不同，所以索引中的颜色哈希只能互相比较，不能与 imagehash 的结果比较。
+    '''
+    n = rgb.shape[0]
+    rgb = rgb.reshape(n, -1, 3)
+    intensity = rgb @ np.array([0.299, 0.587, 0.114])
+    high = rgb.max(axis=2)
+    low = rgb.min(axis=2)
+    delta = high - low
+    saturation = np.where(high > 0, delta * 255 / np.maximum(high, 1), 0)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    safe_delta = np.maximum(delta, 1e-9)
+    hue = np.select([high == r, high == g], [(g - b) / safe_delta, 2 + (b - r) / safe_delta], 4 + (r - g) / safe_delta)
+    hue = (hue / 6) % 1 * 255
+    black = intensity < 256 // 8
+    gray = ~black & (saturation < 256 // 3)
+    colors = ~black & ~gray
+    faint = colors & (saturation < 256 * 2 // 3)
+    bright = colors & (saturation > 256 * 2 // 3)
+    hue_bins = np.minimum((hue * 6 / 255).astype(int), 5)
+    one_hot = hue_bins[..., None] == np.arange(6)
+    color_count = np.maximum(colors.sum(axis=1), 1)[:, None]
+    fractions = np.concatenate([black.mean(axis=1)[:, None], gray.mean(axis=1)[:, None],
+                                (one_hot & faint[..., None]).sum(axis=1) / color_count,
+                                (one_hot & bright[..., None]).sum(axis=1) / color_count], axis=1)
+    values = np.minimum((fractions * 8).astype(int), 7)
+    return ((values[..., None] >> np.array([2, 1, 0])) & 1).astype(bool).reshape(n, -1)
+
+
+def compute_hashes(thumbnails, hash_size):
+    '''
+    从 (N, side, side, 3) 的缩略图批量计算四种哈希值，返回 [(phash, dhash, ahash, colorhash), ...]。
+    pHash 与 imagehash.phash 一样对 hash_size * 4 边长的灰度图做二维 DCT，取左上角低频系数与其中位数比较；
+    dHash 和 aHash 用面积平均矩阵从同一张灰度图缩小得到。
+    '''
+    n, side = thumbnails.shape[0], thumbnails.shape[1]
+    # 与 PIL 的 convert('L') 使用相同的定点数权重和取整，pHash 的结果才与 imagehash 一致
+    gray = ((thumbnails.astype(np.int64) @ np.array([19595, 38470, 7471]) + 0x8000) >> 16).astype(np.float64)
+
+    dct = dct_matrix(side)
+    low_frequency = (dct @ gray @ dct.T)[:, :hash_size, :hash_size].reshape(n, -1)
+    phash = low_frequency > np.median(low_frequency, axis=1, keepdims=True)
+
+    rows = area_matrix(hash_size, side)
+    columns = area_matrix(hash_size + 1, side)
+    wide = rows @ gray @ columns.T
+    dhash = (wide[:, :, 1:] > wide[:, :, :-1]).reshape(n, -1)
+    small = rows @ gray @ rows.T
+    ahash = (small > small.mean(axis=(1, 2), keepdims=True)).reshape(n, -1)
+
+    return list(zip(bits_to_hex(phash), bits_to_hex(dhash), bits_to_hex(ahash),
+                    bits_to_hex(color_hash_bits(thumbnails))))
+
+
+def hash_batch(entries, corrupt_folder, hash_size=8):
+    '''
+    计算一批 (path, size, mtime_ns) 的哈希值，每张图片只解码一次。
+    返回 (结果 [(path, size, mtime_ns, phash, dhash, ahash, colorhash, width, height), ...], 损坏图片数, 总耗时)。
+    '''
+    start_time = time.time()
+    decoded, thumbnails = [], []
+    corrupt_count = 0
+    for image_path, size, mtime_ns in entries:
+        try:
+            thumbnail, (width, height) = load_thumbnail(image_path, hash_size * 4)
+            thumbnails.append(thumbnail)
+            decoded.append(((image_path, size, mtime_ns), (width, height)))
+        except Exception as e:
+            logging.error(f"无法处理图片 {image_path}: {e}")
+            shutil.move(image_path, os.path.join(corrupt_folder, os.path.basename(image_path)))
+            corrupt_count += 1
+    results = []
+    if thumbnails:
+        hashes = compute_hashes(np.stack(thumbnails), hash_size)
+        results = [entry + hash_values + dimensions for (entry, dimensions), hash_values in zip(decoded, hashes)]
+    return results, corrupt_count, time.time() - start_time
+
+
+def sample_digest(image_path, size):
+    '''只读取文件开头和结尾的 SAMPLE_BYTES 字节计算摘要。'''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, 'rb') as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if size > SAMPLE_BYTES:
+            f.seek(max(SAMPLE_BYTES, size - SAMPLE_BYTES))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def full_digest(image_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def group_exact_duplicates(entries, indexed=(), stored_digests=None):
+    '''
+    依次按文件大小、首尾采样摘要和完整摘要分组，找出字节完全相同的文件，不解码任何图片。
+    indexed 是索引中已有的 (path, size, mtime_ns)，stored_digests 是其中已经保存过的 {path: 完整摘要}；
+    新文件与已有文件相同时保留已有的文件。只有包含新文件的组才会继续计算摘要。
+    返回 (需要计算哈希值的 entries, [(完整摘要, [(path, size, mtime_ns), ...]), ...], 本次计算的 {path: 完整摘要})，
+    每组的第一个文件是保留的文件，其余的都是新文件。
+    '''
+    indexed = set(indexed)
+    stored_digests = stored_digests or {}
+    digests = {}
+
+    def digest_of(entry):
+        if entry[0] in stored_digests:
+            return stored_digests[entry[0]]
+        digests[entry[0]] = full_digest(entry[0])
+        return digests[entry[0]]
+
+    def refine(groups, key):
+        # 只对还有多个文件、且至少有一个新文件的组计算下一级的键
+        candidates = [entry for group in groups if len(group) > 1 and not indexed.issuperset(group)
+                      for entry in group]
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            keys = list(executor.map(key, candidates))
+        refined = defaultdict(list)
+        for entry, entry_key in zip(candidates, keys):
+            refined[entry_key].append(entry)
+        return refined
+
+    by_size = defaultdict(list)
+    for entry in itertools.chain(indexed, entries):
+        by_size[entry[1]].append(entry)
+    by_sample = refine(by_size.values(), lambda entry: (entry[1], sample_digest(entry[0], entry[1])))
+    by_digest = refine(by_sample.values(), digest_of)
+
+    exact_groups = []
+    for digest, group in by_digest.items():
+        # 已有的文件排在前面，多个已有文件相同时只保留第一个，其余已有文件不移动
+        group = sorted(group, key=lambda entry: (entry not in indexed, entry))
+        group = group[:1] + [entry for entry in group[1:] if entry not in indexed]
+        if len(group) > 1:
+            exact_groups.append((digest, group))
+    duplicates = {entry for _, group in exact_groups for entry in group[1:]}
+    return [entry for entry in entries if entry not in duplicates], exact_groups, digests
+
+
+# 不参与扫描的子文件夹
+SKIPPED_FOLDERS = {"_duplicates", "_corrupt"}
+# 支持的图像格式
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+# 采样摘要读取文件开头和结尾的字节数
+SAMPLE_BYTES = 64 * 1024
+# JPEG 按至少缩略图边长这么多倍的尺寸解码，再用 LANCZOS 缩小
+DRAFT_FACTOR = 4
+# 每个进程任务包含的图片数
+HASH_CHUNK_SIZE = 64
+# 哈希算法版本，改变后索引中已有的图片会重新计算
+HASH_VERSION = '2'
+HASH_COLUMNS = ('phash', 'dhash', 'ahash', 'colorhash')
+
+
+class PhashIndex:
+    '''
+    保存在 SQLite 中的哈希索引，以路径、文件大小和修改时间为键，保存 pHash、dHash、aHash、颜色哈希和图片的宽高。
+    digest 列是文件的完整摘要，只在查找字节相同的文件时按需计算，没有计算过的为 NULL。
+    '''
+
+    def __init__(self, index_path, hash_size):
+        self.conn = sqlite3.connect(index_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images ('
+                          'id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, phash TEXT)')
+        stored = self.conn.execute("SELECT value FROM meta WHERE key = 'hash_size'").fetchone()
+        if stored is None:
+            self.conn.execute("INSERT INTO meta VALUES ('hash_size', ?)", (str(hash_size),))
+            self.conn.commit()
+        elif int(stored[0]) != hash_size:
+            raise ValueError(f"索引 {index_path} 的 hash_size 为 {stored[0]}，与当前的 {hash_size} 不一致")
+
+        # 旧版本的索引只有 phash 一列
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(images)')}
+        for column in HASH_COLUMNS[1:]:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE images ADD COLUMN {column} TEXT')
+        # 旧版本的索引没有宽高，这些行的宽高为 NULL，需要时再从文件头读取
+        for column in ('width', 'height'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE images ADD COLUMN {column} INTEGER')
+        if 'digest' not in columns:
+            self.conn.execute('ALTER TABLE images ADD COLUMN digest TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS images_size ON images (size)')
+        version = self.conn.execute("SELECT value FROM meta WHERE key = 'hash_version'").fetchone()
+        if version is None or version[0] != HASH_VERSION:
+            # 哈希算法变了，把已有的图片标记为需要重新计算
+            self.conn.execute('UPDATE images SET mtime_ns = -1')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('hash_version', ?)", (HASH_VERSION,))
+        self.conn.commit()
+
+    def stale(self, entries, chunk_size=500):
+        '''返回 (path, size, mtime_ns) 中索引里没有或已经修改过的图片。'''
+        stale = []
+        entries = iter(entries)
+        while chunk := list(itertools.islice(entries, chunk_size)):
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(f'SELECT path, size, mtime_ns FROM images WHERE path IN ({placeholders})',
+                                     [path for path, _, _ in chunk])
+            known = {(path, size, mtime_ns) for path, size, mtime_ns in rows}
+            stale.extend(entry for entry in chunk if entry not in known)
+        return stale
+
+    def update(self, rows):
+        '''写入 (path, size, mtime_ns, phash, dhash, ahash, colorhash, width, height) ，已有的路径保留原来的 id。'''
+        self.conn.executemany('INSERT INTO images (path, size, mtime_ns, phash, dhash, ahash, colorhash, width, height) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                              'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                              'phash = excluded.phash, dhash = excluded.dhash, ahash = excluded.ahash, '
+                              'colorhash = excluded.colorhash, width = excluded.width, height = excluded.height, '
+                              'digest = NULL', rows)
+        self.conn.commit()
+
+    def same_size(self, sizes, exclude_paths, chunk_size=500):
+        '''
+        返回索引中文件大小在 sizes 中的图片 ([(path, size, mtime_ns), ...], {path: 完整摘要})，
+        跳过 exclude_paths 以及磁盘上已经不存在或修改过的文件。
+        '''
+        entries, digests = [], {}
+        sizes = iter(sizes)
+        while chunk := list(itertools.islice(sizes, chunk_size)):
+            placeholders = ','.join('?' * len(chunk))
+            for path, size, mtime_ns, digest in self.conn.execute(
+                    f'SELECT path, size, mtime_ns, digest FROM images WHERE size IN ({placeholders})', chunk):
+                if path in exclude_paths:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    continue
+                entries.append((path, size, mtime_ns))
+                if digest is not None:
+                    digests[path] = digest
+        return entries, digests
+
+    def set_digests(self, digests):
+        '''保存 {path: 完整摘要}，索引中没有的路径被忽略。'''
+        self.conn.executemany('UPDATE images SET digest = ? WHERE path = ?',
+                              [(digest, path) for path, digest in digests.items()])
+        self.conn.commit()
+
+    def remove(self, paths):
+        self.conn.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in paths])
+        self.conn.commit()
+
+    def remove_missing(self, scanned_paths):
+        '''删除索引中不在本次扫描结果里、磁盘上也已经不存在的图片，返回删除的数量。'''
+        missing = [path for path, in self.conn.execute('SELECT path FROM images')
+                   if path not in scanned_paths and not os.path.exists(path)]
+        self.remove(missing)
+        return len(missing)
+
+    def load_hashes(self, column='phash'):
+        '''
+        返回所有图片的 id 和 column 列的整数哈希值，路径和大小只在需要时再查询，以节省内存。
+        还没有计算过这一列的图片（例如旧版本索引中等待重新计算的行）被跳过。
+        '''
+        if column not in HASH_COLUMNS:
+            raise ValueError(f"未知的哈希列 {column}")
+        ids, hashes = [], []
+        for image_id, hash_hex in self.conn.execute(f'SELECT id, {column} FROM images WHERE {column} IS NOT NULL ORDER BY id'):
+            ids.append(image_id)
+            hashes.append(int(hash_hex, 16))
+        return ids, hashes
+
+    def rows(self, ids, chunk_size=500):
+        '''返回 {id: (path, size, phash, width, height)}，旧版本索引中的行宽高为 None。'''
+        rows = {}
+        ids = iter(ids)
+        while chunk := list(itertools.islice(ids, chunk_size)):
+            placeholders = ','.join('?' * len(chunk))
+            for image_id, path, size, phash, width, height in self.conn.execute(
+                    f'SELECT id, path, size, phash, width, height FROM images WHERE id IN ({placeholders})', chunk):
+                rows[image_id] = (path, size, phash, width, height)
+        return rows
+
+    def ids(self, paths, chunk_size=500):
+        ids = set()
+        paths = iter(paths)
+        while chunk := list(itertools.islice(paths, chunk_size)):
+            placeholders = ','.join('?' * len(chunk))
+            ids.update(image_id for image_id, in self.conn.execute(
+                f'SELECT id FROM images WHERE path IN ({placeholders})', chunk))
+        return ids
+
+    def close(self):
+        self.conn.close()
+
+
+def list_images(directory):
+    '''遍历文件夹，返回所有图片的 (path, size, mtime_ns)，跳过重复和损坏图片的文件夹。'''
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames if name not in SKIPPED_FOLDERS]
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                image_path = os.path.join(dirpath, filename)
+                stat = os.stat(image_path)
+                entries.append((image_path, stat.st_size, stat.st_mtime_ns))
+    return entries
+
+
+def hash_images(entries, corrupt_folder, hash_size):
+    '''
+    按 HASH_CHUNK_SIZE 张一批并行计算 (path, size, mtime_ns) 的哈希值，
+    返回 (path, size, mtime_ns, phash, dhash, ahash, colorhash, width, height) 列表、损坏图片数和每张图片的平均处理时间。
+    '''
+    chunks = [entries[i:i + HASH_CHUNK_SIZE] for i in range(0, len(entries), HASH_CHUNK_SIZE)]
+    results = []
+    corrupt_count = 0
+    elapsed_time = 0.0
+    with concurrent.futures.ProcessPoolExecutor() as executor, tqdm(total=len(entries)) as progress:
+        batches = executor.map(hash_batch, chunks, itertools.repeat(corrupt_folder), itertools.repeat(hash_size))
+        for chunk, (batch_results, batch_corrupt, elapsed) in zip(chunks, batches):
+            results.extend(batch_results)
+            corrupt_count += batch_corrupt
+            elapsed_time += elapsed
+            progress.update(len(chunk))
+    return results, corrupt_count, elapsed_time / max(len(entries), 1)
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    '''
+    汉明距离近邻查找的多索引哈希表。
+    哈希值被切成 n_chunks 段，每段一张哈希表。两个哈希值的距离不超过 threshold 时，
+    根据抽屉原理至少有一段的距离不超过 threshold // n_chunks，所以只需在每段里枚举这个半径内的键。
+    '''
+
+    def __init__(self, bits, threshold, expected_size=1000000, n_chunks=None):
+        if n_chunks is None:
+            n_chunks = self.choose_chunks(bits, threshold, expected_size)
+        self.threshold = threshold
+        bounds = [bits * i // n_chunks for i in range(n_chunks + 1)]
+        self.chunks = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        radius = threshold // n_chunks
+        # 每段内距离不超过 radius 的所有翻转掩码
+        self.masks = [[sum(1 << bit for bit in flipped)
+                       for r in range(radius + 1)
+                       for flipped in combinations(range((mask + 1).bit_length() - 1), r)]
+                      for _, mask in self.chunks]
+        self.tables = [defaultdict(list) for _ in self.chunks]
+        self.hashes = []
+
+    @staticmethod
+    def choose_chunks(bits, threshold, expected_size):
+        '''按预计的哈希值数量选择段数，使查表次数和需要验证的候选数之和最小。'''
+        def cost(n_chunks):
+            width = bits // n_chunks
+            probes = n_chunks * sum(comb(width, r) for r in range(threshold // n_chunks + 1))
+            candidates = probes * expected_size / 2 ** width
+            # 实测验证一个候选的开销约为一次查表的三倍
+            return probes + 3 * candidates
+        return min(range(1, min(threshold + 1, bits) + 1), key=cost)
+
+    def add(self, hash_int):
+        index = len(self.hashes)
+        self.hashes.append(hash_int)
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            table[(hash_int >> shift) & mask].append(index)
+        return index
+
+    def query(self, hash_int):
+        '''返回与 hash_int 的汉明距离不超过阈值的 (index, distance)。'''
+        candidates = set()
+        for (shift, mask), table, flips in zip(self.chunks, self.tables, self.masks):
+            key = (hash_int >> shift) & mask
+            for bucket in map(table.get, [key ^ flip for flip in flips]):
+                if bucket:
+                    candidates.update(bucket)
+        for index in candidates:
+            distance = (hash_int ^ self.hashes[index]).bit_count()
+            if distance <= self.threshold:
+                yield index, distance
+
+
+def near_duplicate_pairs(hashes, bits, threshold, n_chunks=None):
+    '''逐个查询再插入，每对距离不超过阈值的哈希值只返回一次 (i, j, distance)。'''
+    index = MultiIndexHash(bits, threshold, len(hashes), n_chunks)
+    for i, hash_int in enumerate(hashes):
+        for j, distance in index.query(hash_int):
+            yield j, i, distance
+        index.add(hash_int)
+
+
+def cluster_pairs(n, pairs):
+    '''用并查集把近似重复的图片对合并成簇，返回包含两张以上图片的簇。'''
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j, _ in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+
+    clusters = defaultdict(list)
+    for i in range(n):
+        clusters[find(i)].append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def find_duplicates(directory, hash_size=8, threshold=0, index_path=None, dhash_threshold=None):
+    '''
+    threshold 是 pHash 的汉明距离阈值；dhash_threshold 不为 None 时，
+    pHash 找到的图片对还要求 dHash 的距离不超过它，减少误判。
+    '''
     start_time = time.time()
 
     # 创建新的文件夹用于存放重复的和损坏的图片
@@ -32,54 +492,178 @@ def find_duplicates(directory, hash_size=8):
     os.makedirs(duplicate_folder, exist_ok=True)
     os.makedirs(corrupt_folder, exist_ok=True)
 
-    # 存储图片哈希值、路径和大小
-    hashes = {}
+    index = PhashIndex(index_path or os.path.join(directory, "_phash_index.sqlite"), hash_size)
 
-    # 支持的图像格式
-    image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+    # 只计算索引中没有或修改过的图片
+    entries = list_images(directory)
+    # 已经删除的文件不会再被重新计算，它们的行要在这里清除，否则会一直留着旧版本的空哈希值
+    removed_count = index.remove_missing({image_path for image_path, _, _ in entries})
+    if removed_count:
+        print(f'从索引中删除了 {removed_count} 张已经不存在的图片。')
+    pending = index.stale(entries)
+    print(f'共 {len(entries)} 张图片，其中 {len(pending)} 张是新增或修改过的，开始查找字节完全相同的文件...')
+    # 新文件也要和索引中大小相同的已有文件比较，它们的完整摘要保存在索引中，没有保存过的在这里补算
+    indexed, stored_digests = index.same_size({size for _, size, _ in pending},
+                                              {image_path for image_path, _, _ in pending})
+    pending, exact_groups, digests = group_exact_duplicates(pending, indexed, stored_digests)
+    exact_count = move_exact_duplicates(exact_groups, duplicate_folder)
+
+    print(f'{len(pending)} 张图片需要计算哈希值...')
+    results, corrupt_count, average_time = hash_images(pending, corrupt_folder, hash_size)
+    index.update(results)
+    index.set_digests(digests)
+    if exact_count:
+        print(f'{exact_count} 张字节完全相同的重复图片无需解码，约节省 {exact_count * average_time:.2f} 秒的解码时间。')
+
+    print(f'开始查找汉明距离不超过 {threshold} 的重复图片...')
+    ids, hashes = index.load_hashes()
+    new_ids = index.ids(image_path for image_path, *_ in results)
+    # 已有图片之间的重复在之前的运行中已经处理过，先把它们放进多索引哈希表，再逐个查询新图片
+    mih = MultiIndexHash(hash_size * hash_size, threshold, len(hashes))
+    order = [position for position, image_id in enumerate(ids) if image_id not in new_ids]
+    for position in order:
+        mih.add(hashes[position])
+    pairs = []
+    for position, image_id in enumerate(ids):
+        if image_id in new_ids:
+            pairs.extend((order[match], position, distance) for match, distance in mih.query(hashes[position]))
+            mih.add(hashes[position])
+            order.append(position)
+    if dhash_threshold is not None:
+        dhashes = dict(zip(*index.load_hashes('dhash')))
+        pairs = [(i, j, distance) for i, j, distance in pairs
+                 if ids[i] in dhashes and ids[j] in dhashes
+                 and hamming_distance(dhashes[ids[i]], dhashes[ids[j]]) <= dhash_threshold]
+    clusters = cluster_pairs(len(ids), pairs)
+
+    duplicate_count = exact_count + resolve_clusters(index, clusters, ids, hashes, duplicate_folder)
+    index.close()
+
+    elapsed_time = time.time() - start_time
+    print(f'处理完成。找到 {len(clusters)} 组重复图片，移动了 {duplicate_count} 张重复的图片和 {corrupt_count} 张损坏的图片,总耗时 {elapsed_time:.2f} 秒。')
 
-    # 遍历文件夹获取所有图片的路径
-    image_paths = [os.path.join(dirpath, filename)
-                   for dirpath, _, filenames in os.walk(directory)
-                   for filename in filenames if filename.lower().endswith(image_extensions)]
 
-    print('开始计算图片哈希值...')
+def move_exact_duplicates(exact_groups, duplicate_folder):
+    '''每组字节相同的文件保留第一个（索引中已有的文件优先，其次是路径排序最前的），其余的移动到重复文件夹，返回移动的文件数。'''
     duplicate_count = 0
-    corrupt_count = 0
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = {executor.submit(calculate_hash, image_path, corrupt_folder): image_path for image_path in image_paths}
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(image_paths)):
-            image_path = futures[future]
-            try:
-                _, hash_val, image_size, error = future.result()
-                if error:
-                    corrupt_count += 1
-                elif hash_val is not None:
-                    if hash_val in hashes:
-                        # 比较当前图片和已存储的图片大小
-                        saved_path, saved_size = hashes[hash_val]
-                        if image_size > saved_size:
-                            # 如果当前图片更大，则移动之前的图片到重复文件夹，并更新哈希表
-                            duplicate_filename = f"{hash_val}_{os.path.basename(saved_path)}"
-                            shutil.move(saved_path, os.path.join(duplicate_folder, duplicate_filename))
-                            duplicate_count += 1
-                            hashes[hash_val] = (image_path, image_size)
-                        else:
-                            # 如果当前图片更小，则移动当前图片
-                            duplicate_filename = f"{hash_val}_{os.path.basename(image_path)}"
-                            shutil.move(image_path, os.path.join(duplicate_folder, duplicate_filename))
-                            duplicate_count += 1
-                    else:
-                        # 如果是第一次遇到该哈希值,则将其记录下来
-                        hashes[hash_val] = (image_path, image_size)
-            except Exception as e:
-                logging.error(f"在处理文件时发生错误 {image_path}: {e}")
+    with open(os.path.join(duplicate_folder, "clusters.txt"), 'a', encoding='utf-8') as report:
+        for digest, group in exact_groups:
+            report.write(f"保留: {group[0][0]}\n")
+            for image_path, _, _ in group[1:]:
+                report.write(f"    重复: {image_path} (字节相同)\n")
+                shutil.move(image_path, os.path.join(duplicate_folder, f"{digest[:16]}_{os.path.basename(image_path)}"))
+                duplicate_count += 1
+    return duplicate_count
+
+
+def keeper_key(row):
+    '''按像素数、再按文件大小选择保留的图片；索引中没有宽高的旧行只读取文件头，不解码。'''
+    image_path, size, _, width, height = row
+    if width is None or height is None:
+        try:
+            with Image.open(image_path) as img:
+                width, height = img.size
+        except Exception:
+            width = height = 0
+    return width * height, size
+
+
+def resolve_clusters(index, clusters, ids, hashes, duplicate_folder):
+    '''每个簇保留像素最多的图片（像素相同时保留文件最大的），其余的移动到重复文件夹并从索引中删除，返回移动的图片数。'''
+    removed = []
+    duplicate_count = 0
+    with open(os.path.join(duplicate_folder, "clusters.txt"), 'a', encoding='utf-8') as report:
+        for members in clusters:
+            rows = index.rows(ids[position] for position in members)
+            # 索引中的文件可能已经被删除
+            missing = [position for position in members if not os.path.exists(rows[ids[position]][0])]
+            removed.extend(rows[ids[position]][0] for position in missing)
+            members = [position for position in members if position not in missing]
+            if len(members) < 2:
+                continue
+
+            # 重新编码的小图可能比原图文件更大，先比较像素数
+            keeper = max(members, key=lambda position: keeper_key(rows[ids[position]]))
+            report.write(f"保留: {rows[ids[keeper]][0]}\n")
+            for position in members:
+                if position == keeper:
+                    continue
+                image_path, _, phash, *_ = rows[ids[position]]
+                distance = hamming_distance(hashes[position], hashes[keeper])
+                report.write(f"    重复: {image_path} (距离 {distance})\n")
+                duplicate_filename = f"{phash}_{os.path.basename(image_path)}"
+                shutil.move(image_path, os.path.join(duplicate_folder, duplicate_filename))
+                removed.append(image_path)
+                duplicate_count += 1
+    index.remove(removed)
+    return duplicate_count
+
+
+def query_folder(folder, index_path, hash_size=8, threshold=0, move=False):
+    '''用已有的索引检查新文件夹中的图片，不重新扫描参考图片，也不修改索引。'''
+    start_time = time.time()
+    index = PhashIndex(index_path, hash_size)
+    corrupt_folder = os.path.join(folder, "_corrupt")
+    os.makedirs(corrupt_folder, exist_ok=True)
+
+    print('开始计算新图片的哈希值...')
+    results, corrupt_count, _ = hash_images(list_images(folder), corrupt_folder, hash_size)
+
+    ids, hashes = index.load_hashes()
+    mih = MultiIndexHash(hash_size * hash_size, threshold, len(hashes))
+    for hash_int in hashes:
+        mih.add(hash_int)
+    matches = []
+    for image_path, _, _, phash, *_ in results:
+        found = sorted(mih.query(int(phash, 16)), key=lambda match: match[1])
+        if found:
+            matches.append((image_path, phash, found))
+    rows = index.rows({ids[position] for _, _, found in matches for position, _ in found})
+    index.close()
+
+    duplicate_folder = os.path.join(folder, "_duplicates")
+    os.makedirs(duplicate_folder, exist_ok=True)
+    with open(os.path.join(folder, "query_matches.txt"), 'w', encoding='utf-8') as report:
+        for image_path, phash, found in matches:
+            report.write(f"新图片: {image_path}\n")
+            for position, distance in found:
+                report.write(f"    已有: {rows[ids[position]][0]} (距离 {distance})\n")
+            if move:
+                shutil.move(image_path, os.path.join(duplicate_folder, f"{phash}_{os.path.basename(image_path)}"))
 
     elapsed_time = time.time() - start_time
-    print(f'处理完成。找到并移动了 {duplicate_count} 张重复的图片和 {corrupt_count} 张损坏的图片,总耗时 {elapsed_time:.2f} 秒。')
+    print(f'查询完成。{len(results)} 张新图片中有 {len(matches)} 张与索引中的图片重复，{corrupt_count} 张损坏,总耗时 {elapsed_time:.2f} 秒。')
+
+
+def benchmark_near_duplicates(n=5000, threshold=6, bits=64, duplicate_ratio=0.1, seed=0):
+    '''用随机哈希值和人为加入的近似重复对比多索引哈希和两两暴力比较的耗时与结果。'''
+    rng = random.Random(seed)
+    hashes = [rng.getrandbits(bits) for _ in range(n)]
+    for i in rng.sample(range(n), int(n * duplicate_ratio)):
+        flipped = sum(1 << bit for bit in rng.sample(range(bits), rng.randint(0, threshold)))
+        hashes[i] = hashes[rng.randrange(n)] ^ flipped
+
+    start_time = time.time()
+    indexed = {(i, j) for i, j, _ in near_duplicate_pairs(hashes, bits, threshold)}
+    indexed_time = time.time() - start_time
+
+    start_time = time.time()
+    brute_force = {(i, j) for i in range(n) for j in range(i + 1, n)
+                   if hamming_distance(hashes[i], hashes[j]) <= threshold}
+    brute_force_time = time.time() - start_time
+
+    print(f'{n} 个哈希值，阈值 {threshold}：多索引哈希 {indexed_time:.2f} 秒，暴力比较 {brute_force_time:.2f} 秒，'
+          f'找到 {len(indexed)} / {len(brute_force)} 对，结果一致: {indexed == brute_force}')
 
 if __name__ == "__main__":
     directory = "your input folder"
+    # 汉明距离阈值，0 表示只查找哈希值完全相同的图片
+    threshold = 6
+    # dHash 的确认阈值，None 表示只使用 pHash
+    dhash_threshold = 10
 
     logging.basicConfig(level=logging.ERROR)
-    find_duplicates(directory)
\ No newline at end of file
+    find_duplicates(directory, threshold=threshold, dhash_threshold=dhash_threshold)
+    # 用已有的索引检查新文件夹：
+    # query_folder("your incoming folder", os.path.join(directory, "_phash_index.sqlite"), threshold=threshold)
+    # benchmark_near_duplicates()
\ No newline at end of file
@@ -9,43 +9,234 @@
 在 main 函数中，脚本会检查输出文件夹是否存在，如果不存在，就创建它。然后，脚本会使用 ThreadPoolExecutor 
 来并行处理所有的图像文件。脚本会遍历输入文件夹中的所有文件，对于每一个图像文件，都会提交一个任务到线程池，
 调用 process_image 函数来处理这个图像。
+默认使用进程池，每次提交一批图像，并限制同时等待的批次数量，所以处理上百万个文件时内存占用也保持不变。
+输出文件比源文件新、并且是用相同的参数生成的（参数和生效时间记录在输出文件夹的 _scale_params.json 中）时跳过，
+重新运行时只处理新增或修改过的图像。处理结束后把吞吐量和失败的文件写入 _scale_summary.json。
+超过 LARGE_PIXELS 的大图（扫描件、全景图）不整张解码：JPEG 用 draft 直接按缩小的尺寸解码，
+未压缩的 TIFF/BMP/PPM 按条带逐段解码并用 Image.reduce 做盒式缩小，最后再用 LANCZOS 缩放，
+结果与整张缩放的误差在一两个灰度级以内。条带解码需要改 Pillow 图像的内部属性，只在验证过的 Pillow 版本上使用，
+并且每个进程第一次使用前用 check_band_reduce 与整张缩小的结果比较一次，不一致时退回整张解码。
+PNG、压缩的 TIFF 等其他格式只能整张解码。每张图像处理前先估计内存峰值（解码的像素加上缩放的中间图像），
+超过 WORKER_MEMORY_BUDGET 的图像不解码、记为失败，所以每个进程的峰值不超过这个上限；
+提交任务时再按所有进程同时处理的内存峰值之和不超过 MEMORY_BUDGET 限流，避免几张大图同时解码把内存用光。
 在脚本的最后，定义了输入文件夹和输出文件夹的路径，并调用 main 函数来开始处理图像。
 """
-from PIL import Image
+from PIL import Image, ImageFile
+import PIL
 import os
-from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import tempfile
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff')
+MAX_SIDE = 2048
+MULTIPLE = 8
+# 影响输出结果的参数，改变后已有的输出会重新生成
+PARAMS = {'max_side': MAX_SIDE, 'multiple': MULTIPLE, 'resample': 'LANCZOS'}
+PARAMS_FILE = '_scale_params.json'
+SUMMARY_FILE = '_scale_summary.json'
+# 每个任务包含的图像数，以及每个任务中所有图像的内存峰值之和的上限
+CHUNK_SIZE = 16
+CHUNK_BYTES = 800 * 1024 ** 2
+# 超过这个像素数的图像走大图路径
+LARGE_PIXELS = 40_000_000
+# 大图先缩小到至少是目标尺寸的 REDUCING_GAP 倍，再用 LANCZOS 缩放
+REDUCING_GAP = 2.0
+# 条带解码时每段最多包含的像素数
+BAND_PIXELS = 16_000_000
+# 条带解码验证过的 Pillow 版本范围 [最低, 最高)
+BAND_PILLOW_VERSIONS = ((9, 0), (13, 0))
+# 每个进程处理一张图像时的内存上限（字节），估计峰值超过它的图像不解码
+WORKER_MEMORY_BUDGET = 4 * 1024 ** 3
+# 所有进程同时处理的图像的内存峰值之和的上限，不能小于 WORKER_MEMORY_BUDGET
+MEMORY_BUDGET = 8 * 1024 ** 3
+# 扫描件和全景图远超 Pillow 的解压炸弹阈值
+Image.MAX_IMAGE_PIXELS = None
+
+
+def target_size(original_width, original_height):
+    # Limit the longer side to a maximum of MAX_SIDE pixels
+    if original_width > original_height:
+        if original_width > MAX_SIDE:
+            new_width = MAX_SIDE
+            scale_factor = new_width / original_width
+            new_height = int(original_height * scale_factor)
+        else:
+            new_width = original_width
+            new_height = original_height
+    else:
+        if original_height > MAX_SIDE:
+            new_height = MAX_SIDE
+            scale_factor = new_height / original_height
+            new_width = int(original_width * scale_factor)
+        else:
+            new_width = original_width
+            new_height = original_height
+    return new_width, new_height
+
+
+def raw_bands(img):
+    '''
+    未压缩图像按行拆成的片段 [(y0, y1, offset, rawmode, stride, orientation)]，
+    不是全宽的 raw 条带（压缩、分块的 TIFF 等）时返回 None。
+    '''
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        return None
+    pieces = []
+    for codec, (x0, y0, x1, y1), offset, args in img.tile:
+        if codec != 'raw' or x0 != 0 or x1 != img.width:
+            return None
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        if not stride:
+            try:
+                stride = len(Image.new(img.mode, (1, 1)).tobytes('raw', rawmode)) * img.width
+            except Exception:
+                return None
+        pieces.append((y0, y1, offset, rawmode, stride, orientation))
+    return pieces
+
+
+def reduce_band(file_path, width, pieces, band_top, band_bottom, factor):
+    '''只解码 [band_top, band_bottom) 这些行，返回按 factor 缩小后的图像。'''
+    # Pillow 11 起 tile 是命名元组
+    make_tile = getattr(ImageFile, '_Tile', lambda *args: args)
+    tiles = []
+    for y0, y1, offset, rawmode, stride, orientation in pieces:
+        top, bottom = max(y0, band_top), min(y1, band_bottom)
+        if top >= bottom:
+            continue
+        # 自下而上存储的行（BMP）在文件中是倒序的
+        skipped_rows = top - y0 if orientation >= 0 else y1 - bottom
+        tiles.append(make_tile('raw', (0, top - band_top, width, bottom - band_top),
+                               offset + skipped_rows * stride, (rawmode, stride, orientation)))
+    with Image.open(file_path) as band:
+        # 把图像的尺寸和解码区域改成这一段，Pillow 就只读取和解码这些行
+        band._size = (width, band_bottom - band_top)
+        band.tile = tiles
+        band.load()
+        return band.reduce(factor)
+
+
+def reduce_in_bands(file_path, img, factor, band_pixels=BAND_PIXELS):
+    '''
+    逐段解码未压缩图像并按 factor 做盒式缩小，内存中只保留一段原图。
+    每段的行数是 factor 的倍数，拼起来与整张图像调用 img.reduce(factor) 的结果相同。
+    '''
+    pieces = raw_bands(img)
+    band_rows = max(factor, band_pixels // img.width // factor * factor)
+    reduced = Image.new(img.mode, (-(-img.width // factor), -(-img.height // factor)))
+    for top in range(0, img.height, band_rows):
+        band = reduce_band(file_path, img.width, pieces, top, min(top + band_rows, img.height), factor)
+        reduced.paste(band, (0, top // factor))
+    return reduced
+
+
+def check_band_reduce(size=(97, 61), factor=3):
+    '''
+    生成几张小的 BMP（行自下而上存储）和未压缩 TIFF，比较逐段缩小和整张 img.reduce 的结果，全部相同时返回 True。
+    每段只有几行，覆盖段的边界、最后一段不足 factor 行等情况。
+    '''
+    noise = Image.effect_noise(size, 64)
+    gradient = Image.linear_gradient('L').resize(size)
+    rgb = Image.merge('RGB', (noise, gradient, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    images = [('bmp', rgb), ('bmp', noise), ('tif', rgb), ('tif', rgb.convert('RGBA'))]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i, (extension, image) in enumerate(images):
+            file_path = os.path.join(temp_dir, f'{i}.{extension}')
+            image.save(file_path)
+            with Image.open(file_path) as img:
+                if raw_bands(img) is None:
+                    return False
+                reduced = reduce_in_bands(file_path, img, factor, band_pixels=size[0] * factor * 2)
+                img.load()
+                if reduced.tobytes() != img.reduce(factor).tobytes():
+                    return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def band_decode_supported():
+    '''当前的 Pillow 能否使用条带解码：版本在 BAND_PILLOW_VERSIONS 范围内，并且 check_band_reduce 通过。'''
+    version = tuple(int(part) for part in PIL.__version__.split('.')[:2])
+    if not BAND_PILLOW_VERSIONS[0] <= version < BAND_PILLOW_VERSIONS[1]:
+        return False
+    try:
+        return check_band_reduce()
+    except Exception:
+        return False
+
+
+def plan_decode(img, new_width, new_height):
+    '''返回 (解码方式, 缩小倍数)：'full' 整张解码，'draft' JPEG 按缩小的尺寸解码，'bands' 逐段解码。'''
+    factor = int(min(img.width / new_width, img.height / new_height) / REDUCING_GAP)
+    if img.width * img.height <= LARGE_PIXELS or factor < 2:
+        return 'full', 1
+    if img.format == 'JPEG':
+        return 'draft', factor
+    if raw_bands(img) is not None and band_decode_supported():
+        return 'bands', factor
+    return 'full', 1
+
+
+def decode_memory(img):
+    '''估计处理一张图像时的内存峰值（字节）：解码出的像素，加上 LANCZOS 先缩放宽度得到的中间图像。'''
+    new_width, new_height = target_size(*img.size)
+    method, factor = plan_decode(img, new_width, new_height)
+    if method == 'draft':
+        # draft 只能按 1/2、1/4 或 1/8 解码
+        scale = 1
+        while scale * 2 <= min(factor, 8):
+            scale *= 2
+        pixels, height = img.width * img.height // scale ** 2, img.height // scale
+    elif method == 'bands':
+        pixels = min(BAND_PIXELS, img.width * img.height) + img.width * img.height // factor ** 2
+        height = img.height // factor
+    else:
+        pixels, height = img.width * img.height, img.height
+    # Pillow 在内存中把多通道图像按每像素 4 字节存储
+    bytes_per_pixel = 1 if img.mode in ('1', 'L', 'P') else 4
+    return (pixels + new_width * height) * bytes_per_pixel
+
+
+def working_bytes(file_path):
+    '''估计处理一张图像时的内存峰值，用于限制同时处理的内存总量；超过 WORKER_MEMORY_BUDGET 的图像不会被解码，返回 0。'''
+    try:
+        with Image.open(file_path) as img:
+            required = decode_memory(img)
+            return required if required <= WORKER_MEMORY_BUDGET else 0
+    except Exception:
+        return 0
+
 
 def process_image(file_path, output_folder):
+    '''处理一张图像，成功时返回 None，失败时返回错误信息。'''
     try:
         with Image.open(file_path) as img:
             original_width, original_height = img.size
             
-            # Limit the longer side to a maximum of 2048 pixels
-            if original_width > original_height:
-                if original_width > 2048:
-                    new_width = 2048
-                    scale_factor = new_width / original_width
-                    new_height = int(original_height * scale_factor)
-                else:
-                    new_width = original_width
-                    new_height = original_height
-            else:
-                if original_height > 2048:
-                    new_height = 2048
-                    scale_factor = new_height / original_height
-                    new_width = int(original_width * scale_factor)
-                else:
-                    new_width = original_width
-                    new_height = original_height
-
-            # Resize the image
+            new_width, new_height = target_size(original_width, original_height)
+            required = decode_memory(img)
+            if required > WORKER_MEMORY_BUDGET:
+                raise MemoryError(f"处理这张图像需要约 {required / 1024 ** 3:.2f} GB 内存，"
+                                  f"超过 WORKER_MEMORY_BUDGET（{WORKER_MEMORY_BUDGET / 1024 ** 3:.2f} GB）")
+
+            # Resize the image. 大图先按缩小的尺寸解码，或者逐段解码并做盒式缩小
+            method, factor = plan_decode(img, new_width, new_height)
+            if method == 'draft':
+                img.draft(None, (int(new_width * REDUCING_GAP), int(new_height * REDUCING_GAP)))
+            elif method == 'bands':
+                img = reduce_in_bands(file_path, img, factor)
             img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
             
-            # Crop the shorter side to make it a multiple of 8
-            if new_width % 8 != 0:
-                new_width = (new_width // 8) * 8
-            if new_height % 8 != 0:
-                new_height = (new_height // 8) * 8
+            # Crop the shorter side to make it a multiple of MULTIPLE
+            if new_width % MULTIPLE != 0:
+                new_width = (new_width // MULTIPLE) * MULTIPLE
+            if new_height % MULTIPLE != 0:
+                new_height = (new_height // MULTIPLE) * MULTIPLE
 
             # Center crop
             left = (img.width - new_width) // 2
@@ -55,29 +246,122 @@ def process_image(file_path, output_folder):
 
             img = img.crop((left, top, right, bottom))
 
-            # Save to the output folder
+            # Save to the output folder. 先写临时文件再替换，中断时不会留下比源文件新的半成品
             output_path = os.path.join(output_folder, os.path.basename(file_path))
-            img.save(output_path)
-            print(f"Processed {file_path} and saved to {output_path}")
+            image_format = Image.registered_extensions()[os.path.splitext(output_path)[1].lower()]
+            img.save(output_path + '.tmp', format=image_format)
+            os.replace(output_path + '.tmp', output_path)
 
     except Exception as e:
-        print(f"Failed to process {file_path}: {str(e)}")
+        return str(e)
+
+
+def process_chunk(tasks):
+    '''处理一批 (file_path, output_folder)，返回失败的 (file_path, error)。'''
+    failures = []
+    for file_path, output_folder in tasks:
+        error = process_image(file_path, output_folder)
+        if error is not None:
+            failures.append((file_path, error))
+    return failures
+
 
-def main(input_folder, output_folder):
+def load_params_since(output_folder):
+    '''返回当前参数开始生效的时间；参数和上次不同时重新记录，之前的输出都会被重新生成。'''
+    params_path = os.path.join(output_folder, PARAMS_FILE)
+    if os.path.exists(params_path):
+        with open(params_path, 'r', encoding='utf-8') as f:
+            recorded = json.load(f)
+        if recorded.get('params') == PARAMS:
+            return recorded['since']
+    since = time.time()
+    with open(params_path, 'w', encoding='utf-8') as f:
+        json.dump({'params': PARAMS, 'since': since}, f, indent=2)
+    return since
+
+
+def iter_tasks(input_folder, output_folder, since, counts):
+    '''遍历输入文件夹，生成需要处理的 ((file_path, output_folder), 内存峰值)，跳过已经是最新的输出。'''
+    for dirpath, dirnames, filenames in os.walk(input_folder):
+        output_path = os.path.join(output_folder, os.path.relpath(dirpath, input_folder))
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                file_path = os.path.join(dirpath, filename)
+                counts['total'] += 1
+                try:
+                    output_mtime = os.path.getmtime(os.path.join(output_path, filename))
+                    if output_mtime >= max(os.path.getmtime(file_path), since):
+                        counts['skipped'] += 1
+                        continue
+                except OSError:
+                    pass
+                os.makedirs(output_path, exist_ok=True)
+                yield (file_path, output_path), working_bytes(file_path)
+
+
+def iter_chunks(tasks, chunk_size):
+    '''
+    按图像数和内存峰值之和分批，生成 (批次, 内存峰值)。
+    一个批次中的图像在同一个进程中依次处理，所以批次的内存峰值是其中最大的一张，而不是总和。
+    '''
+    chunk = []
+    chunk_bytes = chunk_peak = 0
+    for task, required in tasks:
+        chunk.append(task)
+        chunk_bytes += required
+        chunk_peak = max(chunk_peak, required)
+        if len(chunk) == chunk_size or chunk_bytes >= CHUNK_BYTES:
+            yield chunk, chunk_peak
+            chunk = []
+            chunk_bytes = chunk_peak = 0
+    if chunk:
+        yield chunk, chunk_peak
+
+
+def main(input_folder, output_folder, use_processes=True, chunk_size=CHUNK_SIZE, max_pending=None):
+    start_time = time.time()
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    since = load_params_since(output_folder)
+
+    counts = {'total': 0, 'skipped': 0, 'processed': 0}
+    failures = []
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class() as executor:
+        # 同时等待的批次数量有上限，遍历目录和提交任务不会跑到处理前面太远
+        max_pending = max_pending or (os.cpu_count() or 1) * 2
+        # 同时处理的内存峰值之和也有上限；每个批次的峰值不超过 WORKER_MEMORY_BUDGET，所以总能单独提交
+        pending = {}
+        for chunk, chunk_bytes in iter_chunks(iter_tasks(input_folder, output_folder, since, counts), chunk_size):
+            while pending and (len(pending) >= max_pending
+                               or sum(pending.values()) + chunk_bytes > MEMORY_BUDGET):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failures.extend(future.result())
+                    del pending[future]
+            future = executor.submit(process_chunk, chunk)
+            pending[future] = chunk_bytes
+            counts['processed'] += len(chunk)
+        for future in pending:
+            failures.extend(future.result())
+
+    elapsed_time = time.time() - start_time
+    for file_path, error in failures:
+        print(f"Failed to process {file_path}: {error}")
+    summary = {
+        'total': counts['total'],
+        'skipped': counts['skipped'],
+        'processed': counts['processed'] - len(failures),
+        'failed': len(failures),
+        'elapsed_seconds': round(elapsed_time, 2),
+        'images_per_second': round(counts['processed'] / elapsed_time, 2) if elapsed_time > 0 else 0,
+        'failures': [{'file': file_path, 'error': error} for file_path, error in failures],
+    }
+    with open(os.path.join(output_folder, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"共 {summary['total']} 张图像，处理 {summary['processed']} 张，跳过 {summary['skipped']} 张，"
+          f"失败 {summary['failed']} 张，耗时 {summary['elapsed_seconds']} 秒（{summary['images_per_second']} 张/秒）")
 
-    # Use ThreadPoolExecutor to process all images
-    with ThreadPoolExecutor() as executor:
-        # Walk through the directory tree
-        for dirpath, dirnames, filenames in os.walk(input_folder):
-            for filename in filenames:
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                    file_path = os.path.join(dirpath, filename)
-                    output_path = os.path.join(output_folder, os.path.relpath(dirpath, input_folder))
-                    if not os.path.exists(output_path):
-                        os.makedirs(output_path)
-                    executor.submit(process_image, file_path, output_path)
 
 if __name__ == "__main__":
     input_folder = r'your input folder'  # Input folder path
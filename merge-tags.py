@@ -1,23 +1,126 @@
+'''
+把目录下所有 txt 合并成一个文件，并统计标签和单词的频率。
+边读边写入带缓冲的输出文件，不把整个语料放在内存里；每个文件之间加分隔符，避免上一个文件的最后一个标签和下一个文件的第一个标签连在一起。
+标签（按逗号分隔）和单词的出现次数、文档频率用 BoundedCounter 统计，条目数超过上限时只保留计数最大的一半，内存有上限。
+统计结果写入 {输出文件名}_tags.tsv 和 {输出文件名}_tokens.tsv，并打印出现在太多文件中的标签和很少出现的标签（标签数超过上限时不列出罕见标签）。
+'''
 import os
+import re
+import time
+from collections import Counter
 
-def concatenate_txt_files(directory_path, output_file):
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+# 统计表最多保留的条目数
+MAX_ITEMS = 1_000_000
+# 出现在超过这个比例的文件中的标签算作过多出现，几乎不提供信息
+OVER_REPRESENTED_RATIO = 0.5
+# 出现次数不超过这个值的标签算作罕见标签
+RARE_COUNT = 2
+
+
+class BoundedCounter:
+    '''
+    条目数有上限的计数器。条目数超过 max_items 时只保留计数最大的 max_items // 2 个，floor 记录被删除条目的最大计数。
+    从未被删除过的条目计数是准确的；被删除后又出现的条目从 1 重新计数，所以 floor > 0 之后所有计数都只是下限，
+    计数小的条目（例如罕见标签）大多已经被删除过，不能说明它们真的罕见。
+    '''
+
+    def __init__(self, max_items=MAX_ITEMS):
+        self.max_items = max_items
+        self.counts = Counter()
+        self.floor = 0
+
+    def update(self, items):
+        self.counts.update(items)
+        if len(self.counts) > self.max_items:
+            self.prune()
+
+    def prune(self):
+        # 多取一个，它是被删除的条目中计数最大的
+        kept = self.counts.most_common(self.max_items // 2 + 1)
+        self.floor = max(self.floor, kept.pop()[1])
+        self.counts = Counter(dict(kept))
+
+
+class TagStatistics:
+    def __init__(self, max_items=MAX_ITEMS):
+        self.documents = 0
+        self.tags = BoundedCounter(max_items)
+        self.tag_documents = BoundedCounter(max_items)
+        self.tokens = BoundedCounter(max_items)
+        self.token_documents = BoundedCounter(max_items)
+
+    def add(self, content):
+        self.documents += 1
+        tags = [tag.strip().lower() for tag in content.split(',')]
+        tags = [tag for tag in tags if tag]
+        tokens = TOKEN_PATTERN.findall(content.lower())
+        self.tags.update(tags)
+        self.tag_documents.update(set(tags))
+        self.tokens.update(tokens)
+        self.token_documents.update(set(tokens))
+
+    def write_table(self, path, counter, documents_counter):
+        '''按出现次数从高到低写入 item、count、doc_freq、doc_ratio。'''
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('item\tcount\tdoc_freq\tdoc_ratio\n')
+            for item, count in counter.counts.most_common():
+                doc_freq = documents_counter.counts.get(item, 0)
+                f.write(f'{item}\t{count}\t{doc_freq}\t{doc_freq / max(self.documents, 1):.6f}\n')
+
+    def report(self, output_file, top=20):
+        base_name = os.path.splitext(output_file)[0]
+        self.write_table(base_name + '_tags.tsv', self.tags, self.tag_documents)
+        self.write_table(base_name + '_tokens.tsv', self.tokens, self.token_documents)
+
+        print(f'{self.documents} 个文件，{len(self.tags.counts)} 个不同的标签，{len(self.tokens.counts)} 个不同的单词。')
+        if self.tags.floor:
+            print(f'标签超过 {self.tags.max_items} 个，删除过出现次数不超过 {self.tags.floor} 次的标签，表中的计数只是下限。')
+        over_represented = [(tag, doc_freq) for tag, doc_freq in self.tag_documents.counts.most_common(top)
+                            if doc_freq > self.documents * OVER_REPRESENTED_RATIO]
+        for tag, doc_freq in over_represented:
+            print(f'过多出现: {tag} 出现在 {doc_freq / self.documents:.0%} 的文件中')
+        if self.tags.floor:
+            # 计数小的条目正是被删除后重新计数的那些，列出来没有意义
+            print('标签数超过上限，不列出罕见标签；可以调大 max_items 后重新统计。')
+            return
+        rare = [tag for tag, count in self.tags.counts.items() if count <= RARE_COUNT]
+        print(f'出现次数不超过 {RARE_COUNT} 次的罕见标签 {len(rare)} 个，例如: {", ".join(sorted(rare)[:top])}')
+
+
+def concatenate_txt_files(directory_path, output_file, separator=',\n', stats=None):
+    '''边读边写，把目录下所有 txt 用 separator 隔开写入 output_file，返回合并的文件数。'''
     # 获取目录下所有以.txt结尾的文件
-    txt_files = [file for file in os.listdir(directory_path) if file.endswith('.txt')]
+    txt_files = sorted(file for file in os.listdir(directory_path) if file.endswith('.txt'))
+    output_path = os.path.abspath(output_file)
 
-    # 拼接所有.txt文件的内容
-    concatenated_content = ""
-    for txt_file in txt_files:
-        file_path = os.path.join(directory_path, txt_file)
-        with open(file_path, 'r', encoding='utf-8') as file:
-            file_content = file.read()
-            concatenated_content += file_content
+    count = 0
+    with open(output_file, 'w', encoding='utf-8', buffering=1024 * 1024) as output:
+        for txt_file in txt_files:
+            file_path = os.path.join(directory_path, txt_file)
+            if os.path.abspath(file_path) == output_path:
+                continue
+            with open(file_path, 'r', encoding='utf-8') as file:
+                # 去掉首尾的空白和多余的逗号，分隔符由这里统一添加
+                file_content = file.read().strip().strip(',').strip()
+            if not file_content:
+                continue
+            if count:
+                output.write(separator)
+            output.write(file_content)
+            count += 1
+            if stats is not None:
+                stats.add(file_content)
+    return count
 
-    # 将拼接后的内容写入all.txt文件
-    with open(output_file, 'w', encoding='utf-8') as output:
-        output.write(concatenated_content)
 
-# 示例用法
-directory_path = 'your input folder'    # 替换为您的目录路径
-output_file = 'all.txt'
+if __name__ == "__main__":
+    # 示例用法
+    directory_path = 'your input folder'    # 替换为您的目录路径
+    output_file = 'all.txt'
 
-concatenate_txt_files(directory_path, output_file)
\ No newline at end of file
+    start_time = time.time()
+    stats = TagStatistics()
+    count = concatenate_txt_files(directory_path, output_file, stats=stats)
+    stats.report(output_file)
+    print(f'合并了 {count} 个文件，耗时 {time.time() - start_time:.2f} 秒。')
@@ -0,0 +1,96 @@
+'''
+上传给打标模型之前在本地预处理图片：长边缩小到 MAX_EDGE，重新编码为 JPEG 或 WebP。
+视觉模型本来就会缩小图片，上传 10–30 MB 的原图只会增加上传时间和请求延迟。
+预处理在进程池中提前进行，结果缓存在磁盘上（以路径、文件大小、修改时间和参数为键），重试和重新运行都不会重复处理。
+glm4-tagging.py 和 geminipro-cap.py 都通过 iter_prepared 使用这里的预处理结果。
+'''
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+MAX_EDGE = 1536
+IMAGE_FORMAT = 'JPEG'  # 'JPEG' 或 'WEBP'
+QUALITY = 90
+# 缓存文件夹的名字，放在图片文件夹中，遍历图片时需要跳过
+CACHE_FOLDER = '_upload_cache'
+# 在网络请求之前最多提前准备多少张图片
+LOOKAHEAD = 64
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def cache_path_for(image_path, cache_dir, max_edge=MAX_EDGE, image_format=IMAGE_FORMAT, quality=QUALITY):
+    stat = os.stat(image_path)
+    key = f'{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{max_edge}|{image_format}|{quality}'
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + EXTENSIONS[image_format])
+
+
+def prepare_image(image_path, cache_dir, max_edge=MAX_EDGE, image_format=IMAGE_FORMAT, quality=QUALITY):
+    '''
+    缩小并重新编码一张图片，写入缓存，返回 (缓存路径, 原始字节数, 处理后字节数)。
+    已经在缓存中的直接返回；原图已经是目标格式并且不超过 max_edge 时原样复制，不做有损的重新编码。
+    '''
+    cache_path = cache_path_for(image_path, cache_dir, max_edge, image_format, quality)
+    original_size = os.path.getsize(image_path)
+    if os.path.exists(cache_path):
+        return cache_path, original_size, os.path.getsize(cache_path)
+
+    # 预取的进程和打标的进程可能同时处理同一张图片，各自写自己的临时文件，os.replace 保证结果完整
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with Image.open(image_path) as img:
+        if img.format == image_format and max(img.size) <= max_edge:
+            shutil.copyfile(image_path, temp_path)
+        else:
+            img.draft('RGB', (max_edge, max_edge))
+            img = ImageOps.exif_transpose(img).convert('RGB')
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=2.0)
+            img.save(temp_path, format=image_format, quality=quality)
+    os.replace(temp_path, cache_path)
+    return cache_path, original_size, os.path.getsize(cache_path)
+
+
+def iter_prepared(image_paths, cache_dir, stats=None, max_workers=None, lookahead=LOOKAHEAD,
+                  max_edge=MAX_EDGE, image_format=IMAGE_FORMAT, quality=QUALITY):
+    '''
+    用进程池按顺序预处理图片，生成 (image_path, 缓存路径)，最多提前 lookahead 张。
+    预处理失败的图片生成 (image_path, None)，由调用方决定怎么处理。
+    stats 不为 None 时累计 'images'、'original_bytes' 和 'prepared_bytes'。
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    image_paths = iter(image_paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+
+        def submit_next():
+            for image_path in image_paths:
+                pending.append((image_path, executor.submit(prepare_image, image_path, cache_dir,
+                                                            max_edge, image_format, quality)))
+                return
+
+        for _ in range(lookahead):
+            submit_next()
+        while pending:
+            image_path, future = pending.pop(0)
+            submit_next()
+            try:
+                cache_path, original_size, prepared_size = future.result()
+            except Exception as e:
+                print(f"预处理 {image_path} 失败: {e}")
+                yield image_path, None
+                continue
+            if stats is not None:
+                stats['images'] = stats.get('images', 0) + 1
+                stats['original_bytes'] = stats.get('original_bytes', 0) + original_size
+                stats['prepared_bytes'] = stats.get('prepared_bytes', 0) + prepared_size
+            yield image_path, cache_path
+
+
+def report(stats):
+    original_bytes = stats.get('original_bytes', 0)
+    prepared_bytes = stats.get('prepared_bytes', 0)
+    saved = original_bytes - prepared_bytes
+    print(f"上传预处理: {stats.get('images', 0)} 张图片，原始 {original_bytes / 1024 ** 2:.1f} MB，"
+          f"上传 {prepared_bytes / 1024 ** 2:.1f} MB，节省 {saved / 1024 ** 2:.1f} MB"
+          f"（{saved / max(original_bytes, 1):.0%}）。")